@@ -1,21 +1,16 @@
 # ai_literature_extractor.py
 
-from google.generativeai import GenerativeModel
-import google.generativeai as genai
-import os
 import re # 匯入正規表達式模組
 
-# 確保 genai 已被正確設定
-# 請確保您的 .env 檔案中有 GOOGLE_API_KEY
-if os.getenv("GOOGLE_API_KEY"):
-    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-else:
-    # 如果您是從 config.py 讀取，請確保 config 已被載入
-    import config
-    genai.configure(api_key=config.GOOGLE_API_KEY)
+import citation_parser
+import config
+import quota_scheduler
+import resilience
+from genai_client import get_model
 
+# 【修改處】genai 的設定與 GenerativeModel 改為第一次呼叫時才建立（見 genai_client），
+# 匯入本模組不再需要載入 google.generativeai
 
-model = GenerativeModel("gemini-2.5-flash")  # 使用 Google Gemini 的生成模型
 
 def extract_lit_review_via_ai(text: str) -> str:
     """
@@ -30,12 +25,17 @@ def extract_lit_review_via_ai(text: str) -> str:
         "1.  **絕對不要**包含任何你自己的開場白、結語、註解或任何非論文原文的文字。\n"
         "2.  你的輸出**必須**直接以『第二章 文獻探討』或實際的章節內容開頭。\n"
         "3.  請完整輸出該章節的全部內容，直到下一個章節（例如第三章）開始之前為止。\n\n"
-        f"論文全文如下：\n---\n{text[:30000]}\n---\n"  
+        f"論文全文如下：\n---\n{text[:config.SECTION_INPUT_MAX_CHARS]}\n---\n"  
     )
     
     print("    - [AI 擷取] 正在向 AI 發送請求以擷取目標章節...")
     try:
-        response = model.generate_content(prompt)
+        response = resilience.call(
+            "gemini.generate",
+            get_model(config.GENERATIVE_MODEL).generate_content,
+            prompt,
+            quota_tokens=quota_scheduler.estimate_tokens(prompt)
+        )
         ai_output = response.text.strip()
         
         # =================================================================
@@ -53,29 +53,25 @@ def extract_lit_review_via_ai(text: str) -> str:
             print("    - [警告] 清理後內容為空，可能 AI 未正確擷取。")
             return ai_output
 
+    except quota_scheduler.QuotaError:
+        raise
     except Exception as e:
         print(f"    - [錯誤] AI 擷取章節時發生錯誤: {e}")
         return ""
     
-import re
-def extract_inline_citations(paragraph: str):
-    pat = r"\(([A-Z][A-Za-z\- ]+?)(?: et al\.)?,\s*\d{4}\)"
-    return re.findall(pat, paragraph)
-
-
 def extract_paragraphs_with_citations(review_text: str):
     """
     參數：Step 1 回傳的 review_text
-    回傳： [{'idx':0, 'paragraph':..., 'citations':[('Smith', '2022'), ...]}, ...]
+    回傳： [{'idx':0, 'paragraph':..., 'citations':[Citation('Smith', '2022'), ...]}, ...]
     """
     para_list = []
-    raw_paras = [p.strip() for p in review_text.split("\n\n") if p.strip()]
+    raw_paras = [review_text[start:end].strip() for start, end in citation_parser.split_paragraphs(review_text)]
     for idx, p in enumerate(raw_paras):
         cits = citation_parser.extract_inline_citations(p)
         if cits:                       # 只保留有引用的段落
             para_list.append({
                 "idx": idx,
                 "paragraph": p,
-                "citations": list(set(cits))
+                "citations": cits
             })
-    return para_list     
\ No newline at end of file
+    return para_list
\ No newline at end of file
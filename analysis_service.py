@@ -1,19 +1,22 @@
 # analysis_service.py
-import google.generativeai as genai
 import json
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 import config
+import quota_scheduler
+import resilience
+from genai_client import get_genai, get_model
 
 class AnalysisService:
-    def __init__(self):
-        # 初始化 Google Gemini Client
-        genai.configure(api_key=config.GOOGLE_API_KEY)
-        self.model = genai.GenerativeModel(config.GENERATIVE_MODEL)
+    @property
+    def model(self):
+        # Google Gemini Client 延遲到第一次呼叫時才建立，避免拖慢啟動
+        return get_model(config.GENERATIVE_MODEL)
 
-    def get_ai_detection_score(self, text: str) -> float:
+    def get_ai_detection_score(self, text: str) -> Optional[float]:
         """
         使用 Gemini API 判斷是否由 AI 生成。
+        重試用完、斷路器開啟或回應無法解析時回傳 None（未評分），不可當成 0 分的人類寫作。
         """
         print("  - 正在使用 Gemini 進行 AI 生成內容分析...")
         
@@ -47,9 +50,12 @@ class AnalysisService:
         
         try:
             # 呼叫 Gemini API
-            response = self.model.generate_content(
+            response = resilience.call(
+                "gemini.generate",
+                self.model.generate_content,
                 prompt,
-                generation_config=genai.types.GenerationConfig(
+                quota_tokens=quota_scheduler.estimate_tokens(prompt),
+                generation_config=get_genai().types.GenerationConfig(
                     response_mime_type="application/json",
                     temperature=0.2
                 )
@@ -63,12 +69,18 @@ class AnalysisService:
             
             print(f"  - AI 分析理由: {justification}")
             return float(score)
+        except quota_scheduler.QuotaError:
+            # 預算或配額用完不是分析失敗，交給管線決定如何降級
+            raise
         except Exception as e:
-            print(f"  - AI 檢測失敗: {e}")
-            return 0.0
+            print(f"  - AI 檢測失敗，此區塊未評分: {e}")
+            return None
 
-    def generate_search_queries(self, text: str) -> List[str]:
-        """使用 Gemini 從段落中提取適合網路搜尋的關鍵詞組。"""
+    def generate_search_queries(self, text: str, degraded: Optional[List[str]] = None) -> List[str]:
+        """
+        使用 Gemini 從段落中提取適合網路搜尋的關鍵詞組。
+        呼叫失敗時退回以段落開頭搜尋，並在 degraded 中記錄 "query_generation"。
+        """
         # (此函式維持原樣，無需修改)
         prompt = f"""
         Extract up to 3 distinct, concise web-search queries (max 32 tokens each) 
@@ -84,9 +96,12 @@ class AnalysisService:
         JSON output:
         """
         try:
-            response = self.model.generate_content(
+            response = resilience.call(
+                "gemini.generate",
+                self.model.generate_content,
                 prompt,
-                generation_config=genai.types.GenerationConfig(
+                quota_tokens=quota_scheduler.estimate_tokens(prompt),
+                generation_config=get_genai().types.GenerationConfig(
                     response_mime_type="application/json",
                     temperature=0.0
                 )
@@ -94,8 +109,13 @@ class AnalysisService:
             cleaned_json = response.text.strip().lstrip("```json").rstrip("```")
             queries = json.loads(cleaned_json)
             return queries.get("queries", []) if isinstance(queries, dict) else queries
+        except quota_scheduler.QuotaError:
+            # 預算或配額用完不是分析失敗，交給管線決定如何降級
+            raise
         except Exception as e:
-            print(f"查詢生成失敗: {e}")
+            print(f"  - [降級] 查詢生成失敗，改以段落開頭搜尋: {e}")
+            if degraded is not None and "query_generation" not in degraded:
+                degraded.append("query_generation")
             return [text[:128]]
 
     # 【說明】下方的 get_llm_adjudication 函式在您目前的流程中已經不會被使用，
@@ -120,15 +140,21 @@ class AnalysisService:
         - "justification": string, a brief explanation for your decision, referencing the evidence.
         """
         try:
-            response = self.model.generate_content(
+            response = resilience.call(
+                "gemini.generate",
+                self.model.generate_content,
                 prompt,
-                generation_config=genai.types.GenerationConfig(
+                quota_tokens=quota_scheduler.estimate_tokens(prompt),
+                generation_config=get_genai().types.GenerationConfig(
                     response_mime_type="application/json",
                     temperature=0.8
                 )
             )
             cleaned_json = response.text.strip().lstrip("```json").rstrip("```")
             return json.loads(cleaned_json)
+        except quota_scheduler.QuotaError:
+            # 預算或配額用完不是分析失敗，交給管線決定如何降級
+            raise
         except Exception as e:
             print(f"LLM 裁決失敗: {e}")
             return {"verdict": "裁決失敗", "reason": str(e), "confidence": 0.0}
\ No newline at end of file
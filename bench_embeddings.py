@@ -0,0 +1,133 @@
+# bench_embeddings.py
+"""
+Embedding 量化基準測試：以快取中的來源 embedding 為語料，比較 float16 / int8 與 float32 基準的
+召回率 (recall@k)、分數誤差、每個向量的儲存大小、載入與計分時間。
+
+用法：
+    python bench_embeddings.py                     # 使用 cache/content/ 中所有含 embedding 的快取
+    python bench_embeddings.py --k 10 --queries 200
+    python bench_embeddings.py --synthetic 20000   # 快取為空時，以隨機分群向量代替
+
+查詢取自語料本身 (leave-one-out：排除查詢向量自己)，以 float32 的前 k 名為正確答案。
+召回率低於 --min-recall 時以非零狀態碼結束。
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from typing import List
+
+import config
+import embedding_store
+
+FORMATS = ("float32", "float16", "int8")
+
+
+def _load_cached_embeddings() -> List[list]:
+    vectors = []
+    for path in glob.glob(os.path.join(config.CONTENT_CACHE_DIR, "*.json")):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if isinstance(data, dict) and data.get('embedding') is not None:
+            vectors.append(embedding_store.decode_embedding(data['embedding']))
+    return vectors
+
+
+def _synthetic_embeddings(count: int, dim: int, seed: int = 0):
+    # 分群的隨機向量，近鄰結構比純隨機向量更接近真實語料
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, count // 50), dim)).astype(np.float32)
+    labels = rng.integers(0, len(centers), count)
+    return list(centers[labels] + 0.6 * rng.standard_normal((count, dim)).astype(np.float32))
+
+
+def _top_k_excluding(scores, k: int, exclude: int):
+    import numpy as np
+    scores = scores.copy()
+    scores[exclude] = -np.inf
+    index = np.argpartition(-scores, k)[:k]
+    return set(index.tolist())
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="比較量化 embedding 與 float32 基準的召回率")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--synthetic", type=int, default=0, help="以 N 個隨機向量代替快取語料")
+    parser.add_argument("--dim", type=int, default=768, help="隨機向量的維度")
+    parser.add_argument("--min-recall", type=float, default=0.95, help="int8 recall@k 的最低要求")
+    args = parser.parse_args()
+
+    import numpy as np
+
+    if args.synthetic:
+        vectors = _synthetic_embeddings(args.synthetic, args.dim)
+        source = f"隨機分群向量 {len(vectors)} 筆"
+    else:
+        vectors = _load_cached_embeddings()
+        source = f"{config.CONTENT_CACHE_DIR} 中的快取 {len(vectors)} 筆"
+    if len(vectors) <= args.k:
+        print(f"[略過] 語料只有 {len(vectors)} 筆 embedding，不足以計算 recall@{args.k}；可改用 --synthetic N。")
+        return 0
+
+    dims = {v.shape[0] for v in vectors}
+    if len(dims) > 1:
+        print(f"[失敗] 快取中的 embedding 維度不一致: {sorted(dims)}")
+        return 1
+    dim = dims.pop()
+
+    rng = np.random.default_rng(0)
+    query_ids = rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)
+    k = args.k
+
+    print(f"--- 語料: {source}, 維度 {dim}, 查詢 {len(query_ids)} 筆, k={k} ---")
+    legacy_bytes = len(json.dumps(embedding_store.encode_embedding(vectors[0], "json")))
+    print(f"原本的 JSON float list: 每個向量約 {legacy_bytes:,} bytes")
+
+    results = {}
+    baseline = None
+    for storage in FORMATS:
+        encoded = [json.dumps(embedding_store.encode_embedding(v, storage)) for v in vectors]
+        stored_bytes = sum(len(e) for e in encoded) / len(encoded)
+
+        # 載入時間：從 JSON 字串到可計分的矩陣
+        started = time.perf_counter()
+        matrix = embedding_store.QuantizedMatrix([json.loads(e) for e in encoded], storage)
+        load_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        scores = [matrix.scores(vectors[q]) for q in query_ids]
+        score_ms = (time.perf_counter() - started) / len(query_ids) * 1000
+
+        if baseline is None:
+            baseline = scores
+            recall, max_error = 1.0, 0.0
+        else:
+            hits = sum(
+                len(_top_k_excluding(s, k, q) & _top_k_excluding(b, k, q))
+                for s, b, q in zip(scores, baseline, query_ids)
+            )
+            recall = hits / (k * len(query_ids))
+            max_error = max(float(np.abs(s - b).max()) for s, b in zip(scores, baseline))
+
+        results[storage] = recall
+        print(f"{storage:>8}: recall@{k} {recall:.4f} | 最大分數誤差 {max_error:.5f} | "
+              f"儲存 {stored_bytes:,.0f} bytes/向量 ({legacy_bytes / stored_bytes:.1f}x) | "
+              f"記憶體 {matrix.nbytes / len(matrix):,.0f} bytes/向量 | "
+              f"載入 {load_seconds:.2f} s | 計分 {score_ms:.2f} ms/查詢")
+
+    if results["int8"] < args.min_recall:
+        print(f"[失敗] int8 recall@{k} 低於 {args.min_recall}")
+        return 1
+    print("[通過] 量化後的召回率在可接受範圍內。")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+# bench_startup.py
+"""
+CLI 冷啟動基準測試：以 `python -X importtime -c "import main"` 量測匯入時間，並與預算比較。
+
+用法：
+    python bench_startup.py            # 量測 3 次取中位數
+    python bench_startup.py --runs 5 --top 15
+
+超過 config.STARTUP_IMPORT_BUDGET_MS，或任何重量級套件在匯入 main 時就被載入，
+會以非零狀態碼結束，可直接放進 CI。
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+import config
+
+# 這些套件必須延遲到第一次使用時才載入
+HEAVY_MODULES = [
+    "google.generativeai",
+    "langchain_text_splitters",
+    "langchain",
+    "tiktoken",
+    "trafilatura",
+    "PyPDF2",
+    "numpy",
+    "requests",
+]
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def _run_importtime(target: str) -> List[Tuple[str, int, int, int]]:
+    """回傳 [(module, self_us, cumulative_us, indent), ...]。"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+        cwd=here, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"匯入 {target} 失敗:\n{proc.stderr[-2000:]}")
+
+    entries = []
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            entries.append((module, int(self_us), int(cumulative_us), len(indent)))
+    return entries
+
+
+def _summarize(entries) -> Tuple[int, Dict[str, int]]:
+    # 最外層 (縮排最小) 的累計時間加總即為總匯入時間
+    min_indent = min(e[3] for e in entries)
+    total_us = sum(e[2] for e in entries if e[3] == min_indent)
+    cumulative = {}
+    for module, _, cumulative_us, _ in entries:
+        cumulative[module] = max(cumulative.get(module, 0), cumulative_us)
+    return total_us, cumulative
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="量測 `import main` 的冷啟動時間")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=config.STARTUP_IMPORT_BUDGET_MS)
+    args = parser.parse_args()
+
+    totals = []
+    cumulative = {}
+    for _ in range(args.runs):
+        total_us, cumulative = _summarize(_run_importtime("main"))
+        totals.append(total_us)
+    median_ms = statistics.median(totals) / 1000
+
+    print(f"--- import main 冷啟動時間 (中位數, {args.runs} 次): {median_ms:.1f} ms / 預算 {args.budget_ms:.0f} ms ---")
+    print(f"累計耗時最多的模組 (前 {args.top} 名):")
+    for module, cumulative_us in sorted(cumulative.items(), key=lambda x: x[1], reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {module}")
+
+    eager = [m for m in HEAVY_MODULES if m in cumulative]
+    ok = True
+    if eager:
+        print(f"[失敗] 以下重量級套件在匯入 main 時就被載入: {', '.join(eager)}")
+        ok = False
+    if median_ms > args.budget_ms:
+        print(f"[失敗] 冷啟動時間超過預算 ({median_ms:.1f} ms > {args.budget_ms:.0f} ms)")
+        ok = False
+    if ok:
+        print("[通過] 冷啟動時間在預算內。")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
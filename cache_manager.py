@@ -2,17 +2,82 @@ import sqlite3
 import json
 import hashlib
 import os
-from typing import Dict, Any, Optional, List
+import tempfile
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Iterator
 
 import config
 
+# 跨 process 的鎖使用 OS 的 advisory lock：持有者當機時由作業系統自動釋放，不需要判斷殘留鎖
+if os.name == 'nt':
+    import msvcrt
+
+    def _try_lock_fd(fd: int) -> bool:
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def _unlock_fd(fd: int):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _try_lock_fd(fd: int) -> bool:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _unlock_fd(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
 class CacheManager:
+    """
+    查詢與內容快取，可同時被多個執行緒、多個 process 共用同一個快取目錄。
+
+    - 每個執行緒（以及 fork 後的每個 process）各自持有自己的 SQLite 連線，並使用 WAL 與 busy timeout。
+    - 內容檔案先寫入同目錄下的暫存檔，再以 os.replace 原子性地換上，不會留下被截斷的 JSON。
+    - single_flight() 保證多個 worker 同時請求同一個未快取的 URL / 查詢時，只有一個會真正去抓取。
+    """
+
     def __init__(self):
         os.makedirs(config.CACHE_DIR, exist_ok=True)
         os.makedirs(config.CONTENT_CACHE_DIR, exist_ok=True)
-        self.conn = sqlite3.connect(config.QUERY_CACHE_DB)
+        os.makedirs(config.CACHE_LOCK_DIR, exist_ok=True)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._flight_locks = weakref.WeakValueDictionary()
+        self._flight_locks_guard = threading.Lock()
         self._create_tables()
 
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """回傳目前執行緒 / process 專屬的連線，必要時才建立。"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            # check_same_thread=False 只是為了讓 close() 能回收其他執行緒的連線，
+            # 每條連線實際上仍只由建立它的執行緒使用
+            conn = sqlite3.connect(config.QUERY_CACHE_DB, timeout=config.CACHE_BUSY_TIMEOUT,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA busy_timeout={int(config.CACHE_BUSY_TIMEOUT * 1000)}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            with self._connections_lock:
+                self._connections.append((os.getpid(), conn))
+        return conn
+
     def _create_tables(self):
         with self.conn:
             self.conn.execute("""
@@ -40,19 +105,119 @@ class CacheManager:
                 (query_hash, json.dumps(results))
             )
 
+    def _content_path(self, url: str) -> str:
+        return os.path.join(config.CONTENT_CACHE_DIR, f"{self._get_hash(url)}.json")
+
     def get_content_cache(self, url: str) -> Optional[Dict[str, Any]]:
-        url_hash = self._get_hash(url)
-        cache_path = os.path.join(config.CONTENT_CACHE_DIR, f"{url_hash}.json")
-        if os.path.exists(cache_path):
+        cache_path = self._content_path(url)
+        try:
             with open(cache_path, 'r', encoding='utf-8') as f:
                 return json.load(f)
-        return None
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            # 舊版非原子寫入可能留下被截斷的檔案，視為未快取
+            print(f"      - [警告] 快取檔案損毀，將重新抓取: {cache_path}")
+            return None
 
     def set_content_cache(self, url: str, data: Dict[str, Any]):
-        url_hash = self._get_hash(url)
-        cache_path = os.path.join(config.CONTENT_CACHE_DIR, f"{url_hash}.json")
-        with open(cache_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        self._atomic_write_json(self._content_path(url), data)
+
+    def update_content_cache(self, url: str, updates: Dict[str, Any]) -> Dict[str, Any]:
+        """在鎖內讀取、合併、寫回，避免兩個 worker 各自寫入不同欄位時互相覆蓋。"""
+        with self._key_lock(f"content:{url}"):
+            data = self.get_content_cache(url) or {}
+            data.update(updates)
+            self.set_content_cache(url, data)
+            return data
+
+    def _atomic_write_json(self, path: str, data: Any):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=".json")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @contextmanager
+    def single_flight(self, key: str) -> Iterator[None]:
+        """
+        同一個 key 同時間只允許一個 worker 進入。
+        用法：進入後先重新檢查快取，仍未命中才真正抓取並寫入快取；
+        其他 worker 會在此等待，離開等待後即可直接讀到快取結果。
+        """
+        with self._key_lock(key):
+            yield
+
+    @contextmanager
+    def _key_lock(self, key: str) -> Iterator[None]:
+        # 同一 process 內先用執行緒鎖排隊，再用鎖檔與其他 process 排隊
+        with self._flight_lock(key):
+            lock_path = os.path.join(config.CACHE_LOCK_DIR, f"{self._get_hash(key)}.lock")
+            fd = self._acquire_lock_file(lock_path)
+            try:
+                yield
+            finally:
+                self._release_lock_file(lock_path, fd)
+
+    def _flight_lock(self, key: str) -> threading.Lock:
+        with self._flight_locks_guard:
+            lock = self._flight_locks.get(key)
+            if lock is None:
+                lock = self._flight_locks[key] = threading.Lock()
+            return lock
+
+    @staticmethod
+    def _is_current_lock_file(fd: int, lock_path: str) -> bool:
+        try:
+            current = os.stat(lock_path)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(fd)
+        return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+
+    def _acquire_lock_file(self, lock_path: str) -> int:
+        """開啟鎖檔並取得 advisory lock，回傳檔案描述子。持有者當機時鎖會由作業系統釋放。"""
+        started = time.time()
+        warned = False
+        while True:
+            fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+            while not _try_lock_fd(fd):
+                if not warned and time.time() - started > config.SINGLE_FLIGHT_TIMEOUT:
+                    print(f"      - [警告] 等待快取鎖已超過 {config.SINGLE_FLIGHT_TIMEOUT} 秒，持續等待中: {lock_path}")
+                    warned = True
+                time.sleep(config.SINGLE_FLIGHT_POLL_INTERVAL)
+            # POSIX 上前一個持有者釋放前會刪除鎖檔；拿到的若是已被刪除的舊檔，就重新開啟
+            if os.name == 'nt' or self._is_current_lock_file(fd, lock_path):
+                return fd
+            _unlock_fd(fd)
+            os.close(fd)
+
+    @staticmethod
+    def _release_lock_file(lock_path: str, fd: int):
+        try:
+            if os.name != 'nt':
+                # 在持有鎖的情況下刪除，等待中的 worker 會發現檔案已換過而重新開啟；
+                # Windows 無法刪除已開啟的檔案，鎖檔留著重複使用
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+        finally:
+            _unlock_fd(fd)
+            os.close(fd)
 
     def close(self):
-        self.conn.close()
\ No newline at end of file
+        """關閉本 process 內所有執行緒建立的連線。"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for pid, conn in connections:
+            # fork 前繼承來的連線不可在子 process 中使用，直接捨棄
+            if pid == os.getpid():
+                conn.close()
+        self._local = threading.local()
@@ -0,0 +1,358 @@
+# checker_daemon.py
+"""
+常駐服務模式：在本機提供 HTTP API，讓 LMS 等系統上傳 PDF 並取回報告。
+
+啟動：python main.py --serve
+
+API：
+    POST /jobs?filename=thesis.pdf&priority=3
+                                     (body 為 PDF 原始位元組；priority 選填，數字越小越優先) -> {"job_id": ...}
+    GET  /jobs/<job_id>              -> 工作狀態
+    GET  /jobs/<job_id>/events       -> 以 NDJSON 串流進度事件，工作結束時關閉連線
+    GET  /jobs/<job_id>/report       -> HTML 報告
+    GET  /jobs/<job_id>/summary      -> JSON 總結
+    GET  /health                     -> 服務狀態
+
+例如：
+    curl --data-binary @thesis.pdf -H "Content-Type: application/pdf" \
+         "http://127.0.0.1:8765/jobs?filename=thesis.pdf"
+
+工作佇列存放在 SQLite (config.JOB_DB)，服務重啟後未完成的工作會重新排入佇列。
+佇列依優先權排序，同優先權則先到先做；API 配額也依同一個優先權分配 (見 quota_scheduler)。
+所有 worker 共用同一組 CheckerServices（模型 client、切塊器與快取連線），不必每份文件重新初始化。
+"""
+import itertools
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, parse_qs
+
+import config
+import quota_scheduler
+import resilience
+from document_processor import get_text_splitter
+from genai_client import get_model
+from main import CheckerServices, run_online_check
+
+# 工作狀態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobStore:
+    """以 SQLite 保存工作與進度事件，服務重啟後仍可查詢與續跑。"""
+
+    def __init__(self, db_path: str = config.JOB_DB):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=config.CACHE_BUSY_TIMEOUT, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    doc_path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT {config.DOCUMENT_PRIORITY_DEFAULT},
+                    html_report TEXT,
+                    json_report TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+            """)
+            # 舊版資料庫沒有 priority 欄位
+            columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+            if "priority" not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT {config.DOCUMENT_PRIORITY_DEFAULT}")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_events (
+                    job_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    event_json TEXT NOT NULL,
+                    PRIMARY KEY (job_id, seq)
+                );
+            """)
+
+    def create(self, doc_path: str, job_id: str, priority: int) -> str:
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (job_id, doc_path, status, priority, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, doc_path, QUEUED, priority, now, now)
+            )
+        return job_id
+
+    def update(self, job_id: str, **fields):
+        fields['updated_at'] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self.conn:
+            self.conn.execute(f"UPDATE jobs SET {columns} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def add_event(self, job_id: str, event: Dict):
+        event = {"time": time.time(), **event}
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO job_events (job_id, seq, event_json) "
+                "SELECT ?, COALESCE(MAX(seq), -1) + 1, ? FROM job_events WHERE job_id = ?",
+                (job_id, json.dumps(event, ensure_ascii=False), job_id)
+            )
+
+    def events_since(self, job_id: str, after_seq: int) -> List[Dict]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT seq, event_json FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after_seq)
+            ).fetchall()
+        return [{"seq": row["seq"], **json.loads(row["event_json"])} for row in rows]
+
+    def unfinished_jobs(self) -> List[Dict]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT job_id, priority FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self.conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def close(self):
+        self.conn.close()
+
+
+class CheckerDaemon:
+    """持有溫熱的服務與 worker pool，從佇列中取出工作執行。"""
+
+    def __init__(self, num_workers: int = config.DAEMON_WORKERS):
+        os.makedirs(config.JOB_UPLOAD_DIR, exist_ok=True)
+        os.makedirs(config.REPORT_OUTPUT_DIR, exist_ok=True)
+        self.store = JobStore()
+        # 佇列項目為 (priority, 到達順序, job_id)
+        self.queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._arrival = itertools.count()
+        self._stopping = threading.Event()
+
+        print("正在初始化服務 (模型 client、切塊器、快取)...")
+        self.services = CheckerServices()
+        # 服務本身都是延遲載入，常駐模式下在這裡預先建立，第一份工作才不必負擔匯入與設定的時間
+        get_model(config.GENERATIVE_MODEL)
+        get_text_splitter()
+
+        self.workers = [
+            threading.Thread(target=self._worker_loop, name=f"checker-worker-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+
+    def start(self):
+        # 上次服務中斷時尚未完成的工作，重新排入佇列
+        for job in self.store.unfinished_jobs():
+            print(f"[INFO] 重新排入未完成的工作: {job['job_id']}")
+            self.store.update(job['job_id'], status=QUEUED)
+            self._enqueue(job['job_id'], job['priority'])
+        for worker in self.workers:
+            worker.start()
+
+    def _enqueue(self, job_id: str, priority: int):
+        self.queue.put((priority, next(self._arrival), job_id))
+
+    def submit(self, filename: str, pdf_bytes: bytes, priority: int = config.DOCUMENT_PRIORITY_DEFAULT) -> str:
+        job_id = uuid.uuid4().hex
+        # 以 job_id 為前綴，避免同名檔案的報告互相覆蓋
+        safe_name = re.sub(r'[^\w.\-]', '_', os.path.basename(filename)) or "upload.pdf"
+        doc_path = os.path.join(config.JOB_UPLOAD_DIR, f"{job_id}_{safe_name}")
+        with open(doc_path, 'wb') as f:
+            f.write(pdf_bytes)
+        self.store.create(doc_path, job_id, priority)
+        self.store.add_event(job_id, {"stage": QUEUED, "priority": priority})
+        self._enqueue(job_id, priority)
+        return job_id
+
+    def _worker_loop(self):
+        while True:
+            _, _, job_id = self.queue.get()
+            # 關閉中不再接新工作；仍在佇列中的工作保留為 queued，下次啟動時續跑
+            if job_id is None or self._stopping.is_set():
+                self.queue.task_done()
+                break
+            try:
+                self._run_job(job_id)
+            finally:
+                self.queue.task_done()
+
+    def _run_job(self, job_id: str):
+        job = self.store.get(job_id)
+        if not job:
+            return
+        self.store.update(job_id, status=RUNNING)
+
+        pipeline_error = {}
+        def on_progress(event: Dict):
+            if event.get('stage') == FAILED:
+                pipeline_error['error'] = event.get('error')
+            self.store.add_event(job_id, event)
+
+        try:
+            report_paths = run_online_check(job['doc_path'], services=self.services, progress=on_progress,
+                                            priority=job['priority'])
+        except Exception as e:
+            print(f"[錯誤] 工作 {job_id} 執行失敗: {e}")
+            self.store.update(job_id, status=FAILED, error=str(e))
+            self.store.add_event(job_id, {"stage": FAILED, "error": str(e)})
+            return
+
+        if pipeline_error:
+            self.store.update(job_id, status=FAILED, error=pipeline_error['error'])
+            return
+
+        html_report, json_report = report_paths or (None, None)
+        self.store.update(job_id, status=DONE, html_report=html_report, json_report=json_report)
+
+    def stop(self):
+        self._stopping.set()
+        for _ in self.workers:
+            # 停止訊號排在所有工作之前
+            self.queue.put((float('-inf'), next(self._arrival), None))
+        for worker in self.workers:
+            worker.join()
+        self.services.close()
+        self.store.close()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    checker: CheckerDaemon = None  # 由 serve() 設定
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path.rstrip('/') != '/jobs':
+            return self._send_json({"error": "not found"}, 404)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0:
+            return self._send_json({"error": "請在 request body 中上傳 PDF"}, 400)
+        if length > config.DAEMON_MAX_UPLOAD_BYTES:
+            return self._send_json({"error": "檔案過大"}, 413)
+
+        pdf_bytes = self.rfile.read(length)
+        if not pdf_bytes.startswith(b'%PDF'):
+            return self._send_json({"error": "上傳內容不是 PDF"}, 400)
+
+        params = parse_qs(parsed.query)
+        filename = params.get('filename', ["upload.pdf"])[0]
+        try:
+            priority = int(params.get('priority', [config.DOCUMENT_PRIORITY_DEFAULT])[0])
+        except ValueError:
+            return self._send_json({"error": "priority 必須是整數"}, 400)
+        job_id = self.checker.submit(filename, pdf_bytes, priority)
+        self._send_json({"job_id": job_id, "status": QUEUED, "priority": priority}, 202)
+
+    def do_GET(self):
+        parts = [p for p in urlparse(self.path).path.split('/') if p]
+
+        if parts == ['health']:
+            return self._send_json({
+                "workers": len(self.checker.workers),
+                "queued": self.checker.queue.qsize(),
+                "jobs": self.checker.store.count_by_status(),
+                "remote_calls": resilience.get_stats(),
+                "quota_used_today": quota_scheduler.get_scheduler().usage_today()
+            })
+
+        if len(parts) < 2 or parts[0] != 'jobs':
+            return self._send_json({"error": "not found"}, 404)
+
+        job = self.checker.store.get(parts[1])
+        if not job:
+            return self._send_json({"error": "找不到此工作"}, 404)
+
+        action = parts[2] if len(parts) > 2 else None
+        if action is None:
+            return self._send_json(job)
+        if action == 'events':
+            return self._stream_events(job['job_id'])
+        if action == 'report':
+            return self._send_file(job.get('html_report'), "text/html; charset=utf-8", job)
+        if action == 'summary':
+            return self._send_file(job.get('json_report'), "application/json; charset=utf-8", job)
+        self._send_json({"error": "not found"}, 404)
+
+    def _stream_events(self, job_id: str):
+        """以 NDJSON 逐行送出進度事件，直到工作完成或失敗。"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        last_seq = -1
+        try:
+            while True:
+                for event in self.checker.store.events_since(job_id, last_seq):
+                    last_seq = event['seq']
+                    self.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode('utf-8'))
+                self.wfile.flush()
+
+                job = self.checker.store.get(job_id)
+                if job['status'] in (DONE, FAILED) and not self.checker.store.events_since(job_id, last_seq):
+                    break
+                time.sleep(config.DAEMON_EVENT_POLL_INTERVAL)
+        except (BrokenPipeError, ConnectionResetError):
+            # 用戶端提前斷線，不影響工作本身
+            pass
+
+    def _send_file(self, path: Optional[str], content_type: str, job: Dict):
+        if job['status'] != DONE:
+            return self._send_json({"error": "工作尚未完成", "status": job['status']}, 409)
+        if not path or not os.path.exists(path):
+            return self._send_json({"error": "此文件未發現高風險段落，沒有產生報告"}, 404)
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(config.REPORT_COPY_BUFFER)
+                if not block:
+                    break
+                self.wfile.write(block)
+
+    def _send_json(self, data: Dict, status: int = 200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host: str = config.DAEMON_HOST, port: int = config.DAEMON_PORT):
+    daemon = CheckerDaemon()
+    daemon.start()
+
+    _RequestHandler.checker = daemon
+    server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.daemon_threads = True
+    print(f"--- 檢測服務已啟動: http://{host}:{port} (workers: {len(daemon.workers)}) ---")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n--- 正在關閉檢測服務 ---")
+    finally:
+        server.server_close()
+        daemon.stop()
@@ -0,0 +1,334 @@
+# citation_parser.py
+"""
+行內引用擷取與文件層級的引用索引。
+
+支援的格式：
+- APA 括號式：(Smith, 2020)、(Smith & Lee, 2020; Wang et al., 2019, p. 5)
+- APA 敘述式：Smith (2020)、Smith and Lee (2020)、Wang et al. (2019)
+- 編號式：[1]、[2, 5]、[3-6]
+- 中文：（王小明，2020）、（王小明、李大華，2019；陳等人，2021）、王小明（2020）、陳等人(2021)
+
+CitationIndex 以段落為單位記錄引用，管線據此把區塊分成「已引用」與「未引用」兩層，
+已引用的區塊只比對其引用的文獻，並以較低優先權使用配額。
+每筆引用都必須能在參考文獻清單中找到對應條目才算數：編號式依編號 (parse_bibliography)，
+作者年份式依第一作者與年份 (parse_author_year_references)。找不到對應條目的引用可能是虛構的，
+該段落仍以一般網路搜尋檢測。
+"""
+import re
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import config
+
+
+class Citation(NamedTuple):
+    authors: str        # 編號式引用時為空字串
+    year: str           # 編號式引用時為空字串
+    number: Optional[int] = None
+    style: str = "apa"  # "apa" | "numbered" | "chinese"
+
+    def label(self) -> str:
+        if self.style == "numbered":
+            return f"[{self.number}]"
+        return f"{self.authors} {self.year}"
+
+
+_YEAR = r"(?:19|20)\d{2}[a-z]?"
+_CJK = r"一-鿿"
+
+# 大寫開頭但不是作者的常見字 (月份、季節、句首介系詞、專有名詞的結尾字)，
+# 避免 "In March (2020)"、"The United States (2020)" 被當成引用
+_NOT_AUTHOR = (
+    r"(?!(?:January|February|March|April|May|June|July|August|September|October|November|December"
+    r"|Spring|Summer|Autumn|Fall|Winter|In|On|By|Since|From|Until|Before|After|During|The|This|Figure|Table"
+    r"|States|Kingdom|Nations|Union|Republic|University|Department|Ministry|Government|Census|Survey"
+    r"|Report|Study|Chapter|Section|Act|Law)\b)"
+)
+# 括號內可能有多筆，以 ; 或 ； 分隔
+_APA_PAREN = re.compile(r"\(([^()]*?" + _YEAR + r"[^()]*?)\)")
+_APA_ITEM = re.compile(
+    r"(?:e\.g\.,?\s*|see\s+|cf\.\s*)?" + _NOT_AUTHOR +
+    r"(?P<authors>[A-Z][A-Za-z'\-]+(?:(?:\s*,\s*|\s+&\s+|\s+and\s+)[A-Z][A-Za-z'\-]+)*(?:\s+et\s+al\.)?)"
+    r",?\s+(?P<year>" + _YEAR + r")"
+)
+_APA_NARRATIVE = re.compile(
+    r"\b" + _NOT_AUTHOR +
+    r"(?P<authors>[A-Z][A-Za-z'\-]+(?:\s+(?:&|and)\s+[A-Z][A-Za-z'\-]+|\s+et\s+al\.)?)\s+\((?P<year>" + _YEAR + r")"
+    r"(?:,\s*p+\.\s*[\d\-–]+)?\)"
+)
+_NUMBERED = re.compile(r"\[(\d{1,3}(?:\s*[-–,，]\s*\d{1,3})*)\]")
+_CJK_AUTHORS = r"(?P<authors>[" + _CJK + r"]{2,4}(?:[、與和及][" + _CJK + r"]{2,4})*(?:等人|等)?)"
+_CJK_PAGE = r"(?:\s*[，,:：]\s*(?:頁|p+\.)?\s*[\d\-–]+)?"
+_CJK_PAREN = re.compile(r"[（(]([^（）()]*?[" + _CJK + r"][^（）()]*?" + _YEAR + r"[^（）()]*?)[）)]")
+# 括號內每一筆都必須整筆符合「作者，年份[，頁碼]」，(調查期間為2020年3月) 之類的說明文字不算引用
+_CJK_ITEM = re.compile(
+    r"(?:參見|見|如)?" + _CJK_AUTHORS + r"\s*[，,、]?\s*(?P<year>" + _YEAR + r")" + _CJK_PAGE
+)
+# 中文沒有空白分詞，作者前面必須是非中文字、標點，或「研究者」「根據」等常見引導詞
+_CJK_NARRATIVE = re.compile(
+    r"(?:(?<![" + _CJK + r"])|(?<=研究者)|(?<=學者)|(?<=作者)|(?<=根據)|(?<=依據))"
+    + _CJK_AUTHORS + r"\s*[（(](?P<year>" + _YEAR + r")" + _CJK_PAGE + r"[）)]"
+)
+# 參考文獻清單的條目開頭：[12] 或 12.
+_BIB_BRACKET = re.compile(r"^[ \t]*\[(\d{1,3})\][ \t]*", re.MULTILINE)
+_BIB_DOTTED = re.compile(r"^[ \t]*(\d{1,3})[.)][ \t]+(?=\S)", re.MULTILINE)
+# 作者年份式條目的開頭：「Smith, J.」或「王小明（」「王小明、」，前面可能有編號
+_BIB_ENTRY_PREFIX = r"^[ \t]*(?:\[\d{1,3}\][ \t]*|\d{1,3}[.)][ \t]+)?"
+_BIB_APA_START = re.compile(_BIB_ENTRY_PREFIX + r"(?P<surname>[A-Z][A-Za-z'\-]+),[ \t]+[A-Z]", re.MULTILINE)
+_BIB_CJK_START = re.compile(
+    _BIB_ENTRY_PREFIX + r"(?P<surname>[" + _CJK + r"]{2,4})(?=[、，,（(．.與和及等])", re.MULTILINE
+)
+_BIB_NOISE = re.compile(r"https?://\S+|doi:\s*\S+|\bdoi\.org/\S+", re.IGNORECASE)
+# 中文敘述句常見的主詞，後面接年份時通常不是引用 (例如「本研究(2021)」「學生(2020)表示」)
+_CJK_NOT_AUTHOR = frozenset({
+    "本研究", "本文", "本計畫", "該研究", "此研究", "研究", "研究者", "研究結果", "筆者", "作者", "學者",
+    "學生", "教師", "老師", "家長", "學校", "受訪者", "參與者", "我們", "他們", "政府", "調查", "結果",
+    "報告", "統計", "資料", "數據",
+})
+# 直接引述：中英文引號內至少數個字
+_QUOTE = re.compile(r"[“\"「『][^”\"」』]{8,}[”\"」』]")
+_SENTENCE_END = re.compile(r"[。．!?！？\n]|\.(?=\s|$)")
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n|(?<=[。．.!?！？])[ \t]*\n")
+
+
+def _expand_numbers(spec: str) -> List[int]:
+    numbers = []
+    for part in re.split(r"\s*[,，]\s*", spec):
+        bounds = re.split(r"\s*[-–]\s*", part)
+        if len(bounds) == 2 and bounds[0].isdigit() and bounds[1].isdigit():
+            start, end = int(bounds[0]), int(bounds[1])
+            if 0 < end - start <= 50:
+                numbers.extend(range(start, end + 1))
+                continue
+        if bounds[0].isdigit():
+            numbers.append(int(bounds[0]))
+    return numbers
+
+
+def _is_cjk_author(authors: str) -> bool:
+    first = re.split(r"[、與和及]", authors)[0]
+    return first not in _CJK_NOT_AUTHOR and authors not in _CJK_NOT_AUTHOR
+
+
+def extract_citations(paragraph: str) -> List[Citation]:
+    """擷取段落中的所有行內引用（依出現順序、去除重複）。"""
+    found: List[Tuple[int, Citation]] = []
+
+    for match in _APA_PAREN.finditer(paragraph):
+        for item in re.split(r"\s*;\s*", match.group(1)):
+            item_match = _APA_ITEM.search(item)
+            if item_match:
+                found.append((match.start(), Citation(item_match['authors'], item_match['year'])))
+    for match in _APA_NARRATIVE.finditer(paragraph):
+        found.append((match.start(), Citation(match['authors'], match['year'])))
+
+    for match in _CJK_PAREN.finditer(paragraph):
+        for item in re.split(r"\s*[;；]\s*", match.group(1)):
+            item_match = _CJK_ITEM.fullmatch(item.strip())
+            if item_match and _is_cjk_author(item_match['authors']):
+                found.append((match.start(), Citation(item_match['authors'], item_match['year'], style="chinese")))
+    for match in _CJK_NARRATIVE.finditer(paragraph):
+        if _is_cjk_author(match['authors']):
+            found.append((match.start(), Citation(match['authors'], match['year'], style="chinese")))
+
+    for match in _NUMBERED.finditer(paragraph):
+        for number in _expand_numbers(match.group(1)):
+            found.append((match.start(), Citation("", "", number, "numbered")))
+
+    citations = []
+    seen = set()
+    for _, citation in sorted(found, key=lambda x: x[0]):
+        if citation not in seen:
+            seen.add(citation)
+            citations.append(citation)
+    return citations
+
+
+def extract_inline_citations(paragraph: str) -> List[Citation]:
+    """舊名稱，保留給既有的呼叫端。"""
+    return extract_citations(paragraph)
+
+
+def has_direct_quote(paragraph: str) -> bool:
+    return bool(_QUOTE.search(paragraph))
+
+
+def strip_citations(text: str) -> str:
+    """移除行內引用標記，剩下的文字較適合拿來搜尋。"""
+    for pattern in (_APA_PAREN, _CJK_PAREN, _NUMBERED):
+        text = pattern.sub("", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def split_paragraphs(text: str) -> List[Tuple[int, int]]:
+    """回傳每個段落在原文中的 (start, end)。PDF 轉出的文字常沒有空行，因此句尾換行也視為段落結束。"""
+    spans = []
+    start = 0
+    for match in _PARAGRAPH_BREAK.finditer(text):
+        if text[start:match.start()].strip():
+            spans.append((start, match.start()))
+        start = match.end()
+    if text[start:].strip():
+        spans.append((start, len(text)))
+    return spans
+
+
+def parse_bibliography(references_text: str, max_chars: int = 128) -> Dict[int, str]:
+    """
+    解析編號式參考文獻清單，回傳 {編號: 作者與標題}，用來把行內的 [n] 對應到文獻。
+    「12.」格式容易和內文數字混淆，因此只接受從 1 開始連續遞增的編號。
+    """
+    matches = list(_BIB_BRACKET.finditer(references_text))
+    if not matches:
+        matches = []
+        for match in _BIB_DOTTED.finditer(references_text):
+            if int(match.group(1)) == len(matches) + 1:
+                matches.append(match)
+
+    references = {}
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(references_text)
+        entry = re.sub(r"\s+", " ", _BIB_NOISE.sub("", references_text[match.end():end])).strip()
+        if entry:
+            references.setdefault(int(match.group(1)), entry[:max_chars])
+    return references
+
+
+def parse_author_year_references(references_text: str) -> Set[Tuple[str, str]]:
+    """
+    解析作者年份式參考文獻清單，回傳 {(第一作者姓氏或中文姓名, 年份)}。
+    每個條目從「姓氏, 名字縮寫」或中文姓名開始，取條目中第一個出現的年份。
+    """
+    starts = sorted(
+        list(_BIB_APA_START.finditer(references_text)) + list(_BIB_CJK_START.finditer(references_text)),
+        key=lambda m: m.start()
+    )
+    entries = set()
+    for i, match in enumerate(starts):
+        end = starts[i + 1].start() if i + 1 < len(starts) else len(references_text)
+        year = re.search(_YEAR, references_text[match.end():end])
+        if year:
+            entries.add((match['surname'].lower(), year.group(0)[:4]))
+    return entries
+
+
+def _first_author_key(citation: Citation) -> str:
+    if citation.style == "chinese":
+        first = re.split(r"[、與和及]", citation.authors)[0]
+        return re.sub(r"等人?$", "", first)
+    return re.split(r"\s*,\s*|\s+&\s+|\s+and\s+|\s+et\s+al\.", citation.authors)[0].lower()
+
+
+# 區塊的引用層級
+UNCITED = "uncited"
+CITED = "cited"
+
+
+class CitedParagraph:
+    def __init__(self, start: int, end: int, citations: List[Citation], has_quote: bool):
+        self.start = start
+        self.end = end
+        self.citations = citations
+        self.has_quote = has_quote
+
+
+class CitationIndex:
+    """單一文件的引用索引：記錄每個段落的位置與其引用，供區塊查詢。"""
+
+    def __init__(self, section_text: str, references: Optional[Dict[int, str]] = None,
+                 author_year_references: Optional[Set[Tuple[str, str]]] = None):
+        self.text = section_text
+        self.references = references or {}
+        self.author_year_references = author_year_references or set()
+        self.paragraphs: List[CitedParagraph] = []
+        for start, end in split_paragraphs(section_text):
+            paragraph = section_text[start:end]
+            self.paragraphs.append(CitedParagraph(start, end, extract_citations(paragraph), has_direct_quote(paragraph)))
+
+    def has_citations(self) -> bool:
+        return any(p.citations for p in self.paragraphs)
+
+    def load_references(self, references_text: str):
+        """由參考文獻章節的文字建立編號與作者年份兩種對照。"""
+        self.references = parse_bibliography(references_text)
+        self.author_year_references = parse_author_year_references(references_text)
+
+    def is_resolved(self, citation: Citation) -> bool:
+        """引用能否對應到參考文獻清單中的條目；對應不到的引用不足以讓段落略過一般檢測。"""
+        if citation.style == "numbered":
+            return citation.number in self.references
+        key, year = _first_author_key(citation), citation.year[:4]
+        if not key:
+            return False
+        if citation.style == "chinese":
+            # 「陳等人」只有姓氏，比對參考文獻中同年份、同姓的作者
+            return any(y == year and (name == key or name.startswith(key))
+                       for name, y in self.author_year_references)
+        return (key, year) in self.author_year_references
+
+    def _overlapping(self, start: int, end: int) -> List[CitedParagraph]:
+        return [p for p in self.paragraphs if p.start < end and p.end > start]
+
+    def citations_in_range(self, start: int, end: int) -> List[Citation]:
+        citations = []
+        for paragraph in self._overlapping(start, end):
+            for citation in paragraph.citations:
+                if citation not in citations:
+                    citations.append(citation)
+        return citations
+
+    def cited_ratio(self, start: int, end: int) -> float:
+        """區塊內屬於「有可對應到文獻的引用」段落的字元比例。"""
+        total = cited = 0
+        for paragraph in self._overlapping(start, end):
+            overlap = min(end, paragraph.end) - max(start, paragraph.start)
+            total += overlap
+            if any(self.is_resolved(c) for c in paragraph.citations):
+                cited += overlap
+        return cited / total if total else 0.0
+
+    def tier(self, start: int, end: int) -> str:
+        return CITED if self.cited_ratio(start, end) >= config.CITED_CHUNK_RATIO else UNCITED
+
+    def citation_queries(self, start: int, end: int, max_queries: int = config.CITED_MAX_QUERIES) -> List[str]:
+        """
+        為區塊產生「只找其引用文獻」的搜尋查詢：作者 + 年份 + 引用所在句子的開頭；
+        編號式引用則直接以參考文獻條目 (作者與標題) 搜尋。不需要再呼叫 Gemini 產生查詢。
+        """
+        queries = []
+        for paragraph in self._overlapping(start, end):
+            text = self.text[max(start, paragraph.start):min(end, paragraph.end)]
+            for citation in paragraph.citations:
+                if not self.is_resolved(citation):
+                    continue
+                if citation.style == "numbered":
+                    query = self.references[citation.number]
+                else:
+                    context = _sentence_around(text, citation)
+                    query = f"{citation.authors} {citation.year} {context}".strip()
+                if query and query not in queries:
+                    queries.append(query[:128])
+                if len(queries) >= max_queries:
+                    return queries
+        return queries
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "paragraphs": len(self.paragraphs),
+            "cited_paragraphs": sum(1 for p in self.paragraphs if any(self.is_resolved(c) for c in p.citations)),
+            "quoted_paragraphs": sum(1 for p in self.paragraphs if p.citations and p.has_quote),
+            "citations": len({c for p in self.paragraphs for c in p.citations}),
+            "unresolved_citations": len({c for p in self.paragraphs for c in p.citations if not self.is_resolved(c)}),
+            "references": len(self.references) + len(self.author_year_references),
+        }
+
+
+def _sentence_around(text: str, citation: Citation, max_chars: int = 60) -> str:
+    """找出引用所在的句子，去掉引用標記後取開頭一段作為搜尋關鍵字。"""
+    marker = f"[{citation.number}" if citation.style == "numbered" else citation.authors
+    position = text.find(marker)
+    if position < 0:
+        position = 0
+    sentence_start = max(text.rfind(p, 0, position) for p in "。．.!?！？\n") + 1
+    end_match = _SENTENCE_END.search(text, position + len(marker))
+    sentence_end = end_match.start() if end_match else len(text)
+    return strip_citations(text[sentence_start:sentence_end])[:max_chars]
@@ -22,8 +22,86 @@ CHUNK_OVERLAP = 100
 SEARCH_RESULTS_PER_QUERY = 10
 SIMILARITY_THRESHOLD = 80
 
+# --- Embedding 儲存格式 (embedding_store.py) ---
+# "json" (原本的浮點數 list) | "float32" | "float16" | "int8"；非 json 格式會先正規化再存成 base64
+# 讀取時會自動辨識格式，切換後舊快取仍可使用。可用 `python bench_embeddings.py` 比較召回率。
+EMBEDDING_STORAGE = "json"
+EMBEDDING_SCORE_BLOCK = 4096   # QuantizedMatrix 分塊計算的列數，限制暫存 float32 的記憶體
+
+# --- 遠端呼叫韌性層 (resilience.py) ---
+# timeout: 單次嘗試逾時；deadline: 含重試的整體時限；hedge: 超過 p95 (或 hedge_after 秒) 仍未回應時送出重複請求
+RESILIENCE_DEFAULTS = {
+    "timeout": 30,
+    "deadline": 90,
+    "max_attempts": 3,
+    "backoff_base": 0.5,
+    "backoff_max": 8,
+    "hedge": False,
+    "hedge_after": None,
+    "hedge_min_samples": 20,
+    "failure_threshold": 5,
+    "reset_timeout": 30,
+}
+RESILIENCE_ENDPOINTS = {
+    "gemini.generate": {"timeout": 60, "deadline": 150},
+    "gemini.embed": {"timeout": 20, "deadline": 60, "hedge": True},
+    "search.google": {"timeout": 10, "deadline": 30},
+    "fetch": {"timeout": 15, "deadline": 35, "max_attempts": 2, "hedge": True, "failure_threshold": 3},
+}
+RESILIENCE_LATENCY_WINDOW = 200   # 計算 p95/p99 時保留的最近樣本數
+RESILIENCE_MAX_THREADS = 32
+
+# --- API 配額排程 (quota_scheduler.py) ---
+# 全域限制 (所有文件、所有 process 共用)；None 表示不限制
+QUOTA_LIMITS = {
+    "gemini.generate": {"rpm": 60, "tpm": 1000000, "daily": 10000},
+    "gemini.embed": {"rpm": 1500, "tpm": None, "daily": None},
+    "search.google": {"rpm": 30, "tpm": None, "daily": 10000},
+}
+QUOTA_DAY_UTC_OFFSET_HOURS = -8   # Google 每日配額以太平洋時間午夜重置
+QUOTA_POLL_INTERVAL = 0.5
+
+# 每份文件的呼叫次數預算；用完時管線會降級而不是失敗
+DOCUMENT_BUDGET = {
+    "gemini.generate": 120,
+    "gemini.embed": 400,
+    "search.google": 60,
+}
+DOCUMENT_PRIORITY_DEFAULT = 5     # 數字越小越優先
+BUDGET_LOW_WATERMARK = 0.3        # 剩餘預算低於此比例時，低風險區塊不再做網路搜尋
+LOW_RISK_AI_SCORE = 30            # AI 分數低於此值視為低風險區塊
+
+# --- 引用感知的分層檢測 (citation_parser.py) ---
+CITED_CHUNK_RATIO = 0.8           # 區塊中有標註引用的段落佔此比例以上，只比對其引用文獻
+CITED_MAX_QUERIES = 2             # 已引用區塊最多送出的搜尋查詢數
+CITED_MAX_CANDIDATES = 2          # 已引用區塊最多下載比對的來源數
+CITED_PRIORITY_OFFSET = 3         # 已引用區塊的配額優先權往後調整的幅度
+REFERENCES_MAX_CHARS = 60000      # 參考文獻清單最多讀取的字元數 (用來把 [n] 對應到文獻)
+
+# --- 串流管線 (控制記憶體峰值) ---
+SECTION_INPUT_MAX_CHARS = 30000   # 送給 AI 擷取章節的全文上限，讀 PDF 時超過即停止
+HIT_SPAN_CHARS = 300              # 每個命中來源只保留的比對片段長度
+REPORT_COPY_BUFFER = 64 * 1024    # 組合報告暫存檔時的複製緩衝大小
+
 CACHE_DIR = "cache"
 QUERY_CACHE_DB = os.path.join(CACHE_DIR, "queries.sqlite")
 CONTENT_CACHE_DIR = os.path.join(CACHE_DIR, "content")
+CACHE_LOCK_DIR = os.path.join(CACHE_DIR, "locks")
+QUOTA_DB = os.path.join(CACHE_DIR, "quota.sqlite")
+CACHE_BUSY_TIMEOUT = 30          # 秒，SQLite 遇到鎖定時的等待時間
+SINGLE_FLIGHT_TIMEOUT = 120      # 秒，等待其他 worker 完成同一個抓取超過這麼久時印出警告（持有者當機時鎖會由作業系統釋放）
+SINGLE_FLIGHT_POLL_INTERVAL = 0.2
+
+REPORT_OUTPUT_DIR = "reports"
+
+# --- 常駐服務模式 (python main.py --serve) ---
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 8765
+DAEMON_WORKERS = 2
+DAEMON_MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+DAEMON_EVENT_POLL_INTERVAL = 0.5   # 秒，串流進度時輪詢新事件的間隔
+JOB_DB = os.path.join(CACHE_DIR, "jobs.sqlite")
+JOB_UPLOAD_DIR = os.path.join("submissions", "jobs")
 
-REPORT_OUTPUT_DIR = "reports"
\ No newline at end of file
+# --- 啟動時間預算 (python bench_startup.py) ---
+STARTUP_IMPORT_BUDGET_MS = 200    # `python -X importtime -c "import main"` 的累計匯入時間上限
@@ -1,11 +1,13 @@
 # document_processor.py
 import re
+import functools
 import config
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator, Iterable, TYPE_CHECKING
 import unicodedata
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from tiktoken import get_encoding
-import PyPDF2
+
+# PyPDF2、langchain 與 tiktoken 載入很慢，只在真正用到時才匯入
+if TYPE_CHECKING:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 
 class Chunk:
@@ -20,16 +22,60 @@ class Chunk:
             "end_char": end_char
         }
 
-def _pdf_to_text(file_path: str) -> str:
-    """從 PDF 檔案中提取純文字，保留換行符。"""
-    text = ""
+def iter_pdf_pages(file_path: str) -> Iterator[str]:
+    """逐頁產生 PDF 的純文字，一次只在記憶體中保留一頁。"""
+    import PyPDF2
     with open(file_path, 'rb') as f:
         reader = PyPDF2.PdfReader(f)
         for page in reader.pages:
             page_text = page.extract_text()
             if page_text:
-                text += page_text + "\n"
-    return text
+                yield page_text + "\n"
+
+def read_pdf_head(file_path: str, max_chars: int = config.SECTION_INPUT_MAX_CHARS) -> str:
+    """
+    串流讀取 PDF，只累積前 max_chars 個字元（AI 擷取章節時也只會用到這麼多）。
+    達到上限後即停止讀取後續頁面。
+    """
+    return _collect_head(iter_pdf_pages(file_path), max_chars)
+
+def _collect_head(pages: Iterable[str], max_chars: int) -> str:
+    parts = []
+    total = 0
+    for page_text in pages:
+        parts.append(page_text)
+        total += len(page_text)
+        if total >= max_chars:
+            break
+    return "".join(parts)[:max_chars]
+
+_REFERENCES_HEADING = re.compile(
+    r"^[ \t]*(?:references|bibliography|參考文獻|參考資料|引用文獻)[ \t]*$", re.IGNORECASE | re.MULTILINE
+)
+
+def read_pdf_references(file_path: str, max_chars: int = config.REFERENCES_MAX_CHARS) -> str:
+    """
+    串流讀取 PDF，回傳最後一個「參考文獻」標題之後的文字（最多 max_chars 字元）。
+    取最後一個標題是為了跳過目錄裡的同名項目。找不到時回傳空字串。
+    """
+    return _collect_references(iter_pdf_pages(file_path), max_chars)
+
+def _collect_references(pages: Iterable[str], max_chars: int) -> str:
+    parts = None
+    total = 0
+    for page_text in pages:
+        headings = list(_REFERENCES_HEADING.finditer(page_text))
+        if headings:
+            parts = [page_text[headings[-1].end():]]
+            total = len(parts[0])
+        elif parts is not None and total < max_chars:
+            parts.append(page_text)
+            total += len(page_text)
+    return "".join(parts)[:max_chars] if parts else ""
+
+def _pdf_to_text(file_path: str) -> str:
+    """從 PDF 檔案中提取純文字，保留換行符。"""
+    return "".join(iter_pdf_pages(file_path))
 
 def _normalize_text(text: str) -> str:
     """執行大小寫、全半形、Unicode 正規化。"""
@@ -37,6 +83,16 @@ def _normalize_text(text: str) -> str:
     text = text.lower()
     return text
 
+@functools.lru_cache(maxsize=1)
+def get_text_splitter() -> "RecursiveCharacterTextSplitter":
+    """建立 tiktoken 切塊器；每個 process 只建立一次，之後重複使用。"""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        model_name="gpt-4",
+        chunk_size=config.CHUNK_SIZE,
+        chunk_overlap=config.CHUNK_OVERLAP,
+    )
+
 # =================================================================
 # 【修改處】這是一個全新的、更簡潔的 process_document 函式
 # 它現在只接收已經被擷取好的純文字，並對其進行切塊
@@ -45,29 +101,28 @@ def process_document(section_text: str, doc_id: str) -> List[Chunk]:
     """
     【已修改】將傳入的章節純文字，切分成帶有位置資訊的區塊。
     """
+    chunks = list(iter_chunks(section_text, doc_id))
+    if chunks:
+        print(f"目標章節已被切成 {len(chunks)} 個區塊進行分析。")
+    return chunks
+
+def iter_chunks(section_text: str, doc_id: str) -> Iterator[Chunk]:
+    """
+    串流版本的切塊：逐一產生 Chunk，呼叫端處理完一塊即可丟棄。
+    """
     if not section_text:
         print("傳入的章節內容為空，已停止分析。")
-        return []
+        return
 
-    tokenizer = get_encoding("cl100k_base")
-    text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-        model_name="gpt-4",
-        chunk_size=config.CHUNK_SIZE,
-        chunk_overlap=config.CHUNK_OVERLAP,
-    )
-
-    split_texts = text_splitter.split_text(section_text)
-    
-    chunks = []
     current_pos = 0
-    for i, text_chunk in enumerate(split_texts):
+    for i, text_chunk in enumerate(get_text_splitter().split_text(section_text)):
         normalized_chunk_text = _normalize_text(text_chunk)
         
         start_char = section_text.find(text_chunk, current_pos)
         end_char = start_char + len(text_chunk)
         current_pos = start_char + 1
         
-        chunk = Chunk(
+        yield Chunk(
             text=normalized_chunk_text,
             doc_id=doc_id,
             chunk_id=i,
@@ -75,7 +130,3 @@ def process_document(section_text: str, doc_id: str) -> List[Chunk]:
             start_char=start_char,
             end_char=end_char
         )
-        chunks.append(chunk)
-        
-    print(f"目標章節已被切成 {len(chunks)} 個區塊進行分析。")
-    return chunks
\ No newline at end of file
@@ -0,0 +1,142 @@
+# embedding_store.py
+"""
+Embedding 的儲存格式與量化比對核心。
+
+快取中的 embedding 可存成以下格式 (config.EMBEDDING_STORAGE)：
+- "json"：原本的浮點數 list，每一維約 10 bytes
+- "float32" / "float16"：正規化後的向量，以 base64 存放原始位元組
+- "int8"：正規化後再以每個向量各自的 scale 量化為 int8 (v ≈ q * scale)，每一維 1 byte
+
+因為儲存前已正規化，cosine similarity 等於內積；QuantizedMatrix.scores() 直接對量化矩陣分塊計算，
+不需要先把整個語料還原成 float32。
+
+讀取時會自動辨識格式，舊的 float list 快取不需要轉換。
+"""
+import base64
+from typing import Any, Dict, List, Sequence, Union
+
+import config
+
+StoredEmbedding = Union[List[float], Dict[str, Any]]
+
+STORAGE_FORMATS = ("json", "float32", "float16", "int8")
+
+
+def _normalize(vector):
+    import numpy as np
+    vector = np.asarray(vector, dtype=np.float32)
+    length = np.linalg.norm(vector)
+    return vector / length if length > 0 else vector
+
+
+def encode_embedding(vector: Sequence[float], storage: str = None) -> StoredEmbedding:
+    """把 embedding 轉成快取用的格式。"""
+    storage = storage or config.EMBEDDING_STORAGE
+    if storage == "json":
+        return [float(x) for x in vector]
+    if storage not in STORAGE_FORMATS:
+        raise ValueError(f"不支援的 embedding 儲存格式: {storage}")
+
+    import numpy as np
+
+    normalized = _normalize(vector)
+    stored = {"dtype": storage, "dim": int(normalized.shape[0])}
+    if storage == "int8":
+        peak = float(np.abs(normalized).max())
+        scale = peak / 127 if peak > 0 else 1.0
+        data = np.clip(np.rint(normalized / scale), -127, 127).astype(np.int8)
+        stored["scale"] = scale
+    else:
+        data = normalized.astype(storage)
+    stored["data"] = base64.b64encode(data.tobytes()).decode('ascii')
+    return stored
+
+
+def _raw_array(stored: Dict[str, Any]):
+    import numpy as np
+    return np.frombuffer(base64.b64decode(stored["data"]), dtype=stored["dtype"])
+
+
+def decode_embedding(stored: StoredEmbedding):
+    """還原為正規化的 float32 向量 (numpy array)。"""
+    import numpy as np
+    if isinstance(stored, dict):
+        vector = _raw_array(stored).astype(np.float32)
+        if stored["dtype"] == "int8":
+            vector *= np.float32(stored["scale"])
+        return vector
+    return _normalize(stored)
+
+
+def score(stored: StoredEmbedding, query) -> float:
+    """單一 embedding 與已正規化 query 的 cosine similarity，直接在儲存格式上計算。"""
+    import numpy as np
+    if isinstance(stored, dict):
+        raw = _raw_array(stored)
+        result = float(raw.astype(np.float32) @ query)
+        return result * stored["scale"] if stored["dtype"] == "int8" else result
+    return float(_normalize(stored) @ query)
+
+
+class QuantizedMatrix:
+    """
+    以原始儲存格式 (int8 + scale、float16 或 float32) 保存多個 embedding，並直接在上面計算分數。
+    每一列都已正規化，所以 scores() 的結果就是 cosine similarity。
+    """
+
+    def __init__(self, stored_embeddings: Sequence[StoredEmbedding], storage: str = None):
+        import numpy as np
+        storage = storage or config.EMBEDDING_STORAGE
+        if storage == "json":
+            storage = "float32"
+        self.storage = storage
+
+        rows = []
+        scales = []
+        for stored in stored_embeddings:
+            if isinstance(stored, dict) and stored["dtype"] == storage:
+                rows.append(_raw_array(stored))
+                scales.append(stored.get("scale", 1.0))
+            else:
+                # 格式不同 (例如舊的 float list) 時先轉成目標格式
+                converted = encode_embedding(decode_embedding(stored), storage)
+                rows.append(_raw_array(converted))
+                scales.append(converted.get("scale", 1.0))
+
+        dtype = np.int8 if storage == "int8" else np.dtype(storage)
+        self.matrix = np.vstack(rows).astype(dtype, copy=False) if rows else np.zeros((0, 0), dtype=dtype)
+        self.scales = np.asarray(scales, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + (self.scales.nbytes if self.storage == "int8" else 0)
+
+    def scores(self, query: Sequence[float], block_rows: int = None):
+        """回傳 query 與每一列的 cosine similarity。分塊計算以限制暫存的 float32 記憶體。"""
+        import numpy as np
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        block_rows = block_rows or config.EMBEDDING_SCORE_BLOCK
+        query = _normalize(query)
+        result = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), block_rows):
+            block = self.matrix[start:start + block_rows]
+            result[start:start + block_rows] = block.astype(np.float32) @ query
+        if self.storage == "int8":
+            result *= self.scales
+        return result
+
+    def top_k(self, query: Sequence[float], k: int):
+        """回傳 (索引, 分數)，依分數由高到低。"""
+        import numpy as np
+        scores = self.scores(query)
+        k = min(k, len(scores))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), scores[:0]
+        index = np.argpartition(-scores, k - 1)[:k]
+        index = index[np.argsort(-scores[index])]
+        return index, scores[index]
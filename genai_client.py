@@ -0,0 +1,39 @@
+# genai_client.py
+"""
+google.generativeai 的延遲載入與共用 client。
+
+匯入 google.generativeai 本身就相當耗時，因此只在第一次真正呼叫 API 時才載入並設定，
+之後同一個 process 內的所有服務共用同一個模組與模型物件。
+"""
+import threading
+from typing import Dict
+
+import config
+
+_lock = threading.Lock()
+_genai = None
+_models: Dict[str, object] = {}
+
+
+def get_genai():
+    """回傳已設定好 API key 的 google.generativeai 模組（第一次呼叫時才匯入）。"""
+    global _genai
+    if _genai is None:
+        with _lock:
+            if _genai is None:
+                import google.generativeai as genai
+                genai.configure(api_key=config.GOOGLE_API_KEY)
+                _genai = genai
+    return _genai
+
+
+def get_model(model_name: str = config.GENERATIVE_MODEL):
+    """回傳共用的 GenerativeModel，每個模型名稱只建立一次。"""
+    model = _models.get(model_name)
+    if model is None:
+        genai = get_genai()
+        with _lock:
+            model = _models.get(model_name)
+            if model is None:
+                model = _models[model_name] = genai.GenerativeModel(model_name)
+    return model
@@ -1,10 +1,15 @@
 # main.py
 import os
+import sys
 import time
+from typing import Iterable, Iterator, Dict, List, Callable, Optional, Tuple
 
+import citation_parser
 import config
+import quota_scheduler
+import resilience
 # 【修改處】引入新的工具和舊的函式
-from document_processor import process_document, Chunk, _pdf_to_text
+from document_processor import iter_chunks, read_pdf_head, read_pdf_references, Chunk
 from ai_literature_extractor import extract_lit_review_via_ai
 # =================================================================
 
@@ -14,61 +19,84 @@ from analysis_service import AnalysisService
 from similarity_service import SimilarityService
 import report_generator
 
-def run_online_check(target_doc_path: str):
-    doc_id = os.path.basename(target_doc_path)
-    print(f"--- 開始線上檢測文件: {doc_id} ---")
-    start_time = time.time()
+ProgressCallback = Callable[[Dict], None]
 
-    # 初始化服務
-    cache = CacheManager()
-    retriever = SearchRetriever(cache)
-    analyzer = AnalysisService()
-    similarity = SimilarityService(cache)
-    
-    # 將整個 PDF 轉為純文字
-    print("正在讀取並轉換 PDF 全文...")
-    full_text = _pdf_to_text(target_doc_path)
-    if not full_text:
-        print("[錯誤] 無法從 PDF 中提取任何文字。")
-        return
 
-    #  呼叫 AI 擷取文獻回顧
-    print("正在呼叫 AI 擷取『文獻回顧』章節...")
-    section_text_for_report = extract_lit_review_via_ai(full_text)
-    if not section_text_for_report:
-        print("[錯誤] AI 未能成功擷取到文獻回顧章節。")
-        return
-    print("[INFO] AI 已成功擷取目標章節！")
+class CheckerServices:
+    """
+    檢測管線需要的所有服務。
+    單次執行時用完即關閉；常駐服務模式下則在多個工作之間共用，保持 client 與快取連線溫熱。
+    """
+
+    def __init__(self):
+        self.cache = CacheManager()
+        self.retriever = SearchRetriever(self.cache)
+        self.analyzer = AnalysisService()
+        self.similarity = SimilarityService(self.cache)
+
+    def close(self):
+        self.cache.close()
 
-    # 將 AI 擷取出的文字，給 document_processor 切塊
-    chunks = process_document(section_text_for_report, doc_id)
-    # =================================================================
-    
-    if not chunks:
-        return
 
-    final_results = []
+def _notify(progress: Optional[ProgressCallback], stage: str, **info):
+    if progress:
+        progress({"stage": stage, **info})
+
+def iter_chunk_results(chunks: Iterable[Chunk], services: CheckerServices,
+                       progress: Optional[ProgressCallback] = None,
+                       citation_index: Optional[citation_parser.CitationIndex] = None) -> Iterator[Dict]:
+    """
+    串流處理每個區塊，只在判定為高風險或檢測不完整 (degraded) 時產生結果。
+    每個區塊處理完後，其候選來源全文即可被釋放。
+    文件預算偏低或用完、或遠端服務無法使用時會降級 (略過部分檢測)，而不是讓整份文件失敗；
+    被略過的步驟記錄在結果的 "degraded" 中，不會被當成「檢測過且沒有問題」。
+    有 citation_index 時，大多已標註引用的區塊只比對其引用文獻，並以較低優先權使用配額。
+    """
+    analyzer = services.analyzer
+    budget = quota_scheduler.current_budget()
     for i, chunk in enumerate(chunks):
-        print(f"\n[INFO] 正在處理區塊 {i+1}/{len(chunks)}...")
+        print(f"\n[INFO] 正在處理區塊 {i+1}...")
+        _notify(progress, "chunk_started", chunk_index=i)
+        degraded = []
+        start, end = chunk.metadata['start_char'], chunk.metadata['end_char']
+        tier = citation_index.tier(start, end) if citation_index else citation_parser.UNCITED
+        citations = citation_index.citations_in_range(start, end) if citation_index else []
         
         # 進行 AI 生成檢測...
-        ai_score = analyzer.get_ai_detection_score(chunk.text)
-        is_ai_generated = ai_score > 80 
-        print(f"  - AI 生成分數: {ai_score:.0f}/100")
+        try:
+            ai_score = analyzer.get_ai_detection_score(chunk.text)
+        except quota_scheduler.QuotaError as e:
+            print(f"  - [降級] 略過 AI 生成檢測: {e}")
+            ai_score = None
+        if ai_score is None:
+            # 未評分不等於低風險
+            degraded.append("ai_detection")
+            is_ai_generated = False
+            print("  - AI 生成分數: 未評分")
+        else:
+            is_ai_generated = ai_score > 80
+            print(f"  - AI 生成分數: {ai_score:.0f}/100")
 
         # 進行線上來源比對...
-        queries = analyzer.generate_search_queries(chunk.text)
-        print(f"  - AI 生成的搜尋查詢: {queries}")
-        urls_titles = retriever.run_searches(queries)
-        
-        candidate_pages = {}
-        for url, title in list(urls_titles.items())[:5]:
-            print(f"    - 下載與清理來源: {title} ({url})")
-            content = retriever.download_and_clean(url)
-            if content:
-                candidate_pages[url] = content
-
-        top_hits = similarity.find_top_hits(chunk.text, candidate_pages)
+        # 已標註引用的區塊也視為低風險
+        low_risk = (ai_score is not None and ai_score < config.LOW_RISK_AI_SCORE) or tier == citation_parser.CITED
+        if low_risk and budget and (budget.is_low("search.google") or budget.is_low("gemini.generate")):
+            print("  - [降級] 文件預算偏低，略過低風險區塊的網路來源比對。")
+            top_hits = []
+            degraded.append("web_search")
+        else:
+            try:
+                if tier == citation_parser.CITED:
+                    print(f"  - [引用] 區塊已標註引用 ({', '.join(c.label() for c in citations[:5])})，只比對其引用文獻。")
+                    with quota_scheduler.lowered_priority(config.CITED_PRIORITY_OFFSET):
+                        top_hits = _find_cited_hits(chunk, citation_index, services, degraded)
+                else:
+                    top_hits = _find_web_hits(chunk, services, degraded)
+            except quota_scheduler.QuotaError as e:
+                print(f"  - [降級] 略過網路來源比對: {e}")
+                top_hits = []
+                if "web_search" not in degraded:
+                    degraded.append("web_search")
 
         # 判斷結果...
         best_hit = None
@@ -82,42 +110,153 @@ def run_online_check(target_doc_path: str):
                  print(f"  - [抄襲判斷] 找到相似來源，但相似度 ({best_hit['similarity']:.3f}) 未達閾值。")
         else:
             print("  - [抄襲判斷] 未發現高相似度網路來源。")
+        if degraded:
+            print(f"  - [降級] 此區塊檢測不完整: {', '.join(degraded)}")
+
+        _notify(progress, "chunk_done", chunk_index=i, suspicious=is_ai_generated or is_plagiarized,
+                tier=tier, degraded=degraded)
 
         # 綜合判斷...
-        if is_ai_generated or is_plagiarized:
-            justifications = []
-            if is_plagiarized:
-                justifications.append(f"與網路來源相似度高達 {best_hit['similarity']:.2f}。")
-            if is_ai_generated:
-                justifications.append(f"AI 生成檢測分數為 {ai_score:.0f}/100。")
-
-            verdict = {
-                "ai_generated": is_ai_generated,
-                "web_plagiarism": is_plagiarized,
-                "confidence": max(best_hit['similarity'] if is_plagiarized else 0, ai_score / 100.0),
-                "justification": " ".join(justifications)
-            }
-            
-            final_results.append({
-                "original_chunk": chunk.__dict__,
-                "source_hit": best_hit,
-                "llm_verdict": verdict 
-            })
+        if not (is_ai_generated or is_plagiarized):
+            if degraded:
+                # 檢測不完整的區塊也要交給報告，讓讀者知道它沒有被完整檢查
+                yield {"original_chunk": chunk.__dict__, "source_hit": None, "llm_verdict": None,
+                       "degraded": degraded}
+            continue
+
+        justifications = []
+        if is_plagiarized:
+            justifications.append(f"與網路來源相似度高達 {best_hit['similarity']:.2f}。")
+        if is_ai_generated:
+            justifications.append(f"AI 生成檢測分數為 {ai_score:.0f}/100。")
+        if citations:
+            justifications.append(f"段落已標註引用: {', '.join(c.label() for c in citations[:5])}。")
+
+        verdict = {
+            "ai_generated": is_ai_generated,
+            "web_plagiarism": is_plagiarized,
+            "confidence": max(best_hit['similarity'] if is_plagiarized else 0, (ai_score or 0.0) / 100.0),
+            "justification": " ".join(justifications)
+        }
+        
+        yield {
+            "original_chunk": chunk.__dict__,
+            "source_hit": best_hit,
+            "llm_verdict": verdict,
+            "degraded": degraded
+        }
+
+def _find_web_hits(chunk: Chunk, services: CheckerServices, degraded: Optional[List[str]] = None) -> List[Dict]:
+    queries = services.analyzer.generate_search_queries(chunk.text, degraded)
+    print(f"  - AI 生成的搜尋查詢: {queries}")
+    urls_titles = services.retriever.run_searches(queries, degraded)
+    
+    # 候選來源逐頁下載、逐頁比對，不會同時保留多篇全文
+    return services.similarity.find_top_hits(
+        chunk.text, services.retriever.iter_candidate_pages(urls_titles, limit=5, degraded=degraded), degraded
+    )
+
+def _find_cited_hits(chunk: Chunk, citation_index: citation_parser.CitationIndex,
+                     services: CheckerServices, degraded: Optional[List[str]] = None) -> List[Dict]:
+    """已引用的區塊：以「作者 + 年份 + 引用句」直接搜尋其引用文獻，不另外呼叫 Gemini 產生查詢。"""
+    queries = citation_index.citation_queries(chunk.metadata['start_char'], chunk.metadata['end_char'])
+    if not queries:
+        return []
+    print(f"  - 引用文獻查詢: {queries}")
+    urls_titles = services.retriever.run_searches(queries, degraded)
+    return services.similarity.find_top_hits(
+        chunk.text, services.retriever.iter_candidate_pages(urls_titles, limit=config.CITED_MAX_CANDIDATES,
+                                                            degraded=degraded),
+        degraded
+    )
+
+def run_online_check(target_doc_path: str, services: Optional[CheckerServices] = None,
+                     progress: Optional[ProgressCallback] = None,
+                     priority: int = config.DOCUMENT_PRIORITY_DEFAULT) -> Optional[Tuple[str, str]]:
+    """
+    檢測單一文件，回傳 (html_report_path, json_report_path)；沒有高風險段落或失敗時回傳 None。
+    services 由呼叫端傳入時（常駐服務模式）不會在結束時關閉。
+    priority 決定配額不足時的排隊順序 (數字越小越優先)，預算見 config.DOCUMENT_BUDGET。
+    """
+    doc_id = os.path.basename(target_doc_path)
+    print(f"--- 開始線上檢測文件: {doc_id} ---")
+    start_time = time.time()
+    _notify(progress, "started", doc_id=doc_id)
+
+    # 初始化服務
+    owns_services = services is None
+    if owns_services:
+        services = CheckerServices()
+
+    try:
+        with quota_scheduler.document(doc_id, priority) as budget:
+            try:
+                return _run_pipeline(target_doc_path, doc_id, services, progress)
+            finally:
+                print(f"--- 文件預算使用量: {budget.summary()} ---")
+    finally:
+        if owns_services:
+            services.close()
+        print("--- 遠端呼叫統計 (本 process 累計) ---")
+        resilience.print_stats()
+        print(f"--- 總耗時: {time.time() - start_time:.2f} 秒 ---")
+
+def _run_pipeline(target_doc_path: str, doc_id: str, services: CheckerServices,
+                  progress: Optional[ProgressCallback]) -> Optional[Tuple[str, str]]:
+    # 逐頁讀取 PDF，只累積 AI 擷取章節所需的長度
+    print("正在讀取並轉換 PDF 全文...")
+    _notify(progress, "reading_pdf")
+    head_text = read_pdf_head(target_doc_path, config.SECTION_INPUT_MAX_CHARS)
+    if not head_text:
+        print("[錯誤] 無法從 PDF 中提取任何文字。")
+        _notify(progress, "failed", error="無法從 PDF 中提取任何文字。")
+        return None
+
+    #  呼叫 AI 擷取文獻回顧
+    print("正在呼叫 AI 擷取『文獻回顧』章節...")
+    _notify(progress, "extracting_section")
+    try:
+        section_text_for_report = extract_lit_review_via_ai(head_text)
+    except quota_scheduler.QuotaError as e:
+        # 連章節都無法擷取時沒有可降級的空間，只能放棄這份文件
+        print(f"[錯誤] 配額不足，無法擷取章節: {e}")
+        _notify(progress, "failed", error=f"配額不足: {e}")
+        return None
+    del head_text
+    if not section_text_for_report:
+        print("[錯誤] AI 未能成功擷取到文獻回顧章節。")
+        _notify(progress, "failed", error="AI 未能成功擷取到文獻回顧章節。")
+        return None
+    print("[INFO] AI 已成功擷取目標章節！")
+    _notify(progress, "section_extracted", section_chars=len(section_text_for_report))
+
+    # 引用預掃描：建立本文件的引用索引，決定每個區塊的檢測層級
+    citation_index = citation_parser.CitationIndex(section_text_for_report)
+    if citation_index.has_citations():
+        # 引用必須對應到參考文獻清單中的條目，才能讓區塊只比對其引用文獻
+        citation_index.load_references(read_pdf_references(target_doc_path))
+    print(f"[INFO] 引用索引: {citation_index.stats()}")
+    _notify(progress, "citations_indexed", **citation_index.stats())
+
+    # 串流管線：章節 -> 區塊 -> 結果 -> 報告（逐筆寫入）
+    chunks = iter_chunks(section_text_for_report, doc_id)
+    results = iter_chunk_results(chunks, services, progress, citation_index)
+    writer = report_generator.StreamingReportWriter(section_text_for_report, doc_id)
+    for result in results:
+        writer.add_result(result)
+    # =================================================================
 
     # 報告輸出
-    if final_results:
+    if writer.total_count or writer.degraded_count:
         print("\n--- 檢測完成，正在生成報告 ---")
-        report_generator.generate_reports(
-            original_text=section_text_for_report, 
-            analysis_results=final_results, 
-            doc_id=doc_id
-        )
+    report_paths = writer.close()
+    if report_paths:
         print(f"報告已生成於 'reports' 資料夾中。")
     else:
         print("\n--- 檢測完成，未發現任何高風險段落 ---")
-
-    cache.close()
-    print(f"--- 總耗時: {time.time() - start_time:.2f} 秒 ---")
+    _notify(progress, "finished", suspicious_chunks=writer.total_count, degraded_chunks=writer.degraded_count,
+            reports=report_paths)
+    return report_paths
 
 
 if __name__ == '__main__':
@@ -125,6 +264,12 @@ if __name__ == '__main__':
     os.makedirs("cache", exist_ok=True)
     os.makedirs("reports", exist_ok=True)
 
+    if "--serve" in sys.argv[1:]:
+        # 常駐服務模式：python main.py --serve
+        import checker_daemon
+        checker_daemon.serve()
+        sys.exit(0)
+
     target_document = "submissions/test.pdf" # 測試檔案放在 submissions 資料夾
     
     if not os.path.exists(target_document):
@@ -0,0 +1,329 @@
+# quota_scheduler.py
+"""
+全域 API 配額排程器。
+
+所有會消耗配額的遠端呼叫 (Gemini 生成、embedding、Custom Search) 在送出前都要先向排程器取得許可
+（由 resilience.call 的 quota_tokens 參數自動處理）：
+
+- 全域限制：每分鐘請求數 (rpm)、每分鐘 token 數 (tpm)、每日請求數 (daily)，見 config.QUOTA_LIMITS。
+  用量記錄在 SQLite (config.QUOTA_DB)，同一個快取目錄下的多個 process 共用同一份配額。
+- 排隊順序：配額不足時依 (文件優先權, 該文件已用量, 到達順序) 排隊，數字越小越先；
+  同優先權下用量少的文件先拿到配額 (fair share)，避免少數大型論文吃光所有配額。
+- 每份文件預算：config.DOCUMENT_BUDGET，用完時拋出 BudgetExceeded，由管線決定如何降級。
+
+用法：
+    with quota_scheduler.document(doc_id, priority=3):
+        ...  # 這段期間的遠端呼叫都記在 doc_id 的預算上
+"""
+import contextvars
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+import config
+
+
+class QuotaError(Exception):
+    """配額相關錯誤的基底類別；管線捕捉這個類別來降級，而不是當成一般失敗。"""
+
+
+class BudgetExceeded(QuotaError):
+    """目前文件在某項資源上的預算已用完。"""
+
+
+class QuotaExhausted(QuotaError):
+    """全域每日配額已用完，今天無法再呼叫。"""
+
+
+class DocumentBudget:
+    def __init__(self, doc_id: str, priority: int = config.DOCUMENT_PRIORITY_DEFAULT,
+                 limits: Optional[Dict[str, int]] = None):
+        self.doc_id = doc_id
+        self.priority = priority
+        self.limits = dict(config.DOCUMENT_BUDGET if limits is None else limits)
+        self.used: Dict[str, int] = {}
+        self.tokens: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def remaining(self, resource: str) -> Optional[int]:
+        limit = self.limits.get(resource)
+        if limit is None:
+            return None
+        return max(0, limit - self.used.get(resource, 0))
+
+    def is_low(self, resource: str) -> bool:
+        """剩餘預算低於 BUDGET_LOW_WATERMARK 比例時，管線會開始略過低風險區塊。"""
+        limit = self.limits.get(resource)
+        if limit is None:
+            return False
+        return self.remaining(resource) <= limit * config.BUDGET_LOW_WATERMARK
+
+    def check(self, resource: str):
+        if self.remaining(resource) == 0:
+            raise BudgetExceeded(f"{self.doc_id} 的 {resource} 預算已用完 ({self.limits[resource]} 次)")
+
+    def charge(self, resource: str, tokens: int):
+        with self._lock:
+            self.used[resource] = self.used.get(resource, 0) + 1
+            self.tokens[resource] = self.tokens.get(resource, 0) + tokens
+
+    def refund(self, resource: str, tokens: int):
+        with self._lock:
+            self.used[resource] = max(0, self.used.get(resource, 0) - 1)
+            self.tokens[resource] = max(0, self.tokens.get(resource, 0) - tokens)
+
+    def summary(self) -> Dict[str, str]:
+        return {
+            resource: f"{self.used.get(resource, 0)}/{limit if limit is not None else '∞'}"
+            for resource, limit in self.limits.items()
+        }
+
+
+_current_budget: contextvars.ContextVar = contextvars.ContextVar("current_budget", default=None)
+_priority_offset: contextvars.ContextVar = contextvars.ContextVar("priority_offset", default=0)
+
+
+def current_budget() -> Optional[DocumentBudget]:
+    return _current_budget.get()
+
+
+@contextmanager
+def document(doc_id: str, priority: int = config.DOCUMENT_PRIORITY_DEFAULT,
+             limits: Optional[Dict[str, int]] = None) -> Iterator[DocumentBudget]:
+    """在這個區塊內發出的遠端呼叫，都記在 doc_id 的預算並依其優先權排隊。"""
+    budget = DocumentBudget(doc_id, priority, limits)
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+@contextmanager
+def lowered_priority(offset: int) -> Iterator[None]:
+    """區塊內的呼叫以較低優先權排隊 (例如已標註引用、風險較低的區塊)。"""
+    token = _priority_offset.set(_priority_offset.get() + offset)
+    try:
+        yield
+    finally:
+        _priority_offset.reset(token)
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估 token 數：中日韓文字約一字一 token，其他約四個字元一 token。"""
+    cjk = sum(1 for ch in text if '　' <= ch <= '鿿' or '가' <= ch <= '힯' or '＀' <= ch <= '￯')
+    return max(1, cjk + (len(text) - cjk) // 4)
+
+
+class QuotaScheduler:
+    def __init__(self, db_path: str = config.QUOTA_DB):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self._local = threading.local()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS quota_usage (
+                resource TEXT NOT NULL,
+                period TEXT NOT NULL,
+                requests INTEGER NOT NULL,
+                tokens INTEGER NOT NULL,
+                PRIMARY KEY (resource, period)
+            );
+        """)
+        # _cond 只保護排隊狀態；SQLite 交易一律在鎖外執行，
+        # 其他 process 持有寫入鎖時才不會讓本 process 的所有執行緒一起卡住
+        self._cond = threading.Condition()
+        self._waiters: Dict[str, list] = {}
+        self._seq = itertools.count()
+        self._last_cleanup = 0.0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """每個執行緒 / process 各自的連線（與 CacheManager 相同）。"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            # 自行管理交易 (BEGIN IMMEDIATE)，確保「檢查 + 扣除」在多個 process 之間是原子的
+            conn = sqlite3.connect(self.db_path, timeout=config.CACHE_BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _periods() -> Tuple[str, str, float]:
+        """回傳 (分鐘區段, 日期區段, 距離下一分鐘的秒數)。"""
+        now = time.time()
+        minute = f"m:{int(now // 60)}"
+        # Google 的每日配額以太平洋時間午夜重置
+        day = "d:" + time.strftime('%Y-%m-%d', time.gmtime(now + config.QUOTA_DAY_UTC_OFFSET_HOURS * 3600))
+        return minute, day, 60 - now % 60
+
+    def _try_consume(self, resource: str, tokens: int,
+                     busy_timeout: float = config.CACHE_BUSY_TIMEOUT) -> Tuple[bool, float]:
+        """
+        嘗試扣除一次配額。回傳 (是否成功, 建議等待秒數)。
+        每日配額用完時拋出 QuotaExhausted；資料庫被其他 process 鎖住超過 busy_timeout 秒時拋出 sqlite3.OperationalError。
+        """
+        limits = config.QUOTA_LIMITS.get(resource, {})
+        minute, day, until_next_minute = self._periods()
+
+        conn = self.conn
+        conn.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for period in (minute, day):
+                conn.execute(
+                    "INSERT OR IGNORE INTO quota_usage (resource, period, requests, tokens) VALUES (?, ?, 0, 0)",
+                    (resource, period)
+                )
+            minute_requests, minute_tokens = conn.execute(
+                "SELECT requests, tokens FROM quota_usage WHERE resource = ? AND period = ?", (resource, minute)
+            ).fetchone()
+            day_requests, = conn.execute(
+                "SELECT requests FROM quota_usage WHERE resource = ? AND period = ?", (resource, day)
+            ).fetchone()
+
+            if limits.get('daily') is not None and day_requests >= limits['daily']:
+                conn.execute("ROLLBACK")
+                raise QuotaExhausted(f"{resource} 今日配額已用完 ({limits['daily']} 次)")
+
+            over_rpm = limits.get('rpm') is not None and minute_requests >= limits['rpm']
+            # 單一請求就超過 tpm 時，只要這一分鐘還沒有其他請求就放行，避免永遠排不到
+            over_tpm = (limits.get('tpm') is not None and minute_requests > 0
+                        and minute_tokens + tokens > limits['tpm'])
+            if over_rpm or over_tpm:
+                conn.execute("ROLLBACK")
+                return False, until_next_minute
+
+            conn.execute(
+                "UPDATE quota_usage SET requests = requests + 1, tokens = tokens + ? "
+                "WHERE resource = ? AND period IN (?, ?)",
+                (tokens, resource, minute, day)
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._cleanup_old_periods(minute)
+        return True, 0.0
+
+    def _cleanup_old_periods(self, current_minute: str):
+        if time.time() - self._last_cleanup < 60:
+            return
+        self._last_cleanup = time.time()
+        self.conn.execute(
+            "DELETE FROM quota_usage WHERE period LIKE 'm:%' AND period != ?", (current_minute,)
+        )
+
+    def acquire(self, resource: str, tokens: int = 0):
+        """
+        取得一次呼叫許可，必要時排隊等待。
+        預算用完拋出 BudgetExceeded；全域每日配額用完拋出 QuotaExhausted。
+        """
+        budget = current_budget()
+        if budget:
+            budget.check(resource)
+        if resource not in config.QUOTA_LIMITS:
+            if budget:
+                budget.charge(resource, tokens)
+            return
+
+        priority = (budget.priority if budget else config.DOCUMENT_PRIORITY_DEFAULT) + _priority_offset.get()
+        used = budget.used.get(resource, 0) if budget else 0
+        entry = (priority, used, next(self._seq))
+
+        with self._cond:
+            waiters = self._waiters.setdefault(resource, [])
+            heapq.heappush(waiters, entry)
+        try:
+            while True:
+                with self._cond:
+                    # 不是排頭就等排頭拿到配額後的通知
+                    while waiters[0] is not entry:
+                        self._cond.wait(timeout=config.QUOTA_POLL_INTERVAL)
+                granted, wait = self._try_consume(resource, tokens)
+                if granted:
+                    break
+                with self._cond:
+                    self._cond.wait(timeout=wait)
+        finally:
+            with self._cond:
+                waiters.remove(entry)
+                heapq.heapify(waiters)
+                self._cond.notify_all()
+
+        if budget:
+            budget.charge(resource, tokens)
+
+    def try_acquire(self, resource: str, tokens: int = 0) -> bool:
+        """不排隊的版本：預算或配額不足時直接回傳 False（用於 hedge 等可有可無的請求）。"""
+        budget = current_budget()
+        if budget and budget.remaining(resource) == 0:
+            return False
+        if resource in config.QUOTA_LIMITS:
+            with self._cond:
+                if self._waiters.get(resource):
+                    return False
+            try:
+                # 不等待其他 process 釋放資料庫寫入鎖
+                granted, _ = self._try_consume(resource, tokens, busy_timeout=0)
+            except (QuotaExhausted, sqlite3.OperationalError):
+                return False
+            if not granted:
+                return False
+        if budget:
+            budget.charge(resource, tokens)
+        return True
+
+    def refund(self, resource: str, tokens: int = 0):
+        """退還一次已取得但沒有送出的呼叫。跨分鐘時退還到目前的分鐘區段，誤差可以接受。"""
+        budget = current_budget()
+        if budget:
+            budget.refund(resource, tokens)
+        if resource not in config.QUOTA_LIMITS:
+            return
+        minute, day, _ = self._periods()
+        self.conn.execute(
+            "UPDATE quota_usage SET requests = MAX(requests - 1, 0), tokens = MAX(tokens - ?, 0) "
+            "WHERE resource = ? AND period IN (?, ?)",
+            (tokens, resource, minute, day)
+        )
+        with self._cond:
+            self._cond.notify_all()
+
+    def usage_today(self) -> Dict[str, int]:
+        _, day, _ = self._periods()
+        rows = self.conn.execute(
+            "SELECT resource, requests FROM quota_usage WHERE period = ?", (day,)
+        ).fetchall()
+        return {resource: requests for resource, requests in rows}
+
+
+_scheduler: Optional[QuotaScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> QuotaScheduler:
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = QuotaScheduler()
+    return _scheduler
+
+
+def acquire(resource: str, tokens: int = 0):
+    get_scheduler().acquire(resource, tokens)
+
+
+def try_acquire(resource: str, tokens: int = 0) -> bool:
+    return get_scheduler().try_acquire(resource, tokens)
+
+
+def refund(resource: str, tokens: int = 0):
+    get_scheduler().refund(resource, tokens)
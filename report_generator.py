@@ -3,7 +3,9 @@
 import json
 import os
 import html
-from typing import List, Dict
+import shutil
+import tempfile
+from typing import List, Dict, Optional, Tuple
 
 import config
 
@@ -13,91 +15,13 @@ def generate_reports(original_text: str, analysis_results: List[Dict], doc_id: s
         return
 
     print("正在生成報告...")
-    os.makedirs(config.REPORT_OUTPUT_DIR, exist_ok=True)
-    
-    html_report_path = _generate_html_report(original_text, analysis_results, doc_id)
-    print(f"HTML 報告已生成: {html_report_path}")
+    writer = StreamingReportWriter(original_text, doc_id)
+    for result in sorted(analysis_results, key=lambda x: x['original_chunk']['metadata']['start_char']):
+        writer.add_result(result)
+    writer.close()
 
-    json_report_path = _generate_json_report(analysis_results, doc_id)
-    print(f"JSON 總結已生成: {json_report_path}")
 
-
-def _generate_html_report(original_text: str, analysis_results: List[Dict], doc_id: str) -> str:
-    highlighted_text = original_text
-    
-    if not analysis_results:
-        return ""
-
-    # 從後往前替換，避免字元索引錯亂
-    sorted_results = sorted(analysis_results, key=lambda x: x['original_chunk']['metadata']['start_char'], reverse=True)
-    
-    for result in sorted_results:
-        chunk_meta = result['original_chunk']['metadata']
-        
-        # =================================================================
-        # 【修改處】因為 chunks 的位置現在直接相對於章節原文，不再需要計算偏移量
-        start = chunk_meta['start_char']
-        end = chunk_meta['end_char']
-        # =================================================================
-        
-        if start < 0 or end > len(highlighted_text):
-            print(f"偵測到無效的高亮位置 (start={start}, end={end})，已跳過此區塊。")
-            continue
-
-        verdict = result.get('llm_verdict', {})
-        is_plagiarism = verdict.get('web_plagiarism', False)
-        is_ai = verdict.get('ai_generated', False)
-        
-        color = "rgba(255, 255, 0, 0.4)"
-        if is_plagiarism and is_ai:
-             color = "rgba(255, 0, 255, 0.5)"
-        elif is_plagiarism:
-            color = "rgba(255, 77, 77, 0.5)"
-        elif is_ai:
-            color = "rgba(255, 165, 0, 0.5)"
-
-        tooltip_text = f"判斷理由: {html.escape(verdict.get('justification', 'N/A'))}\n"
-        tooltip_text += f"信賴度: {verdict.get('confidence', 0.0):.2f}"
-        
-        original_segment = highlighted_text[start:end]
-        highlighted_segment = f'<span class="highlight" style="background-color:{color};" title="{tooltip_text}">{html.escape(original_segment)}</span>'
-        highlighted_text = highlighted_text[:start] + highlighted_segment + highlighted_text[end:]
-
-    table_rows = ""
-    for res in sorted(analysis_results, key=lambda x: x['original_chunk']['metadata']['start_char']):
-        verdict = res.get('llm_verdict', {})
-        source_hit = res.get('source_hit') or {}
-        
-        chunk_meta = res['original_chunk']['metadata']
-        # 同樣地，直接使用 chunk 的位置
-        start = chunk_meta['start_char']
-        end = chunk_meta['end_char']
-        
-        if start < 0 or end > len(original_text):
-            continue
-        display_text = original_text[start:end]
-
-        source_text = source_hit.get('text', 'N/A (無網路來源)')
-        source_url = source_hit.get('url', '#')
-        similarity = source_hit.get('similarity', 0.0)
-        
-        judgement_html = f"""
-        AI 生成: {'是' if verdict.get('ai_generated') else '否'}<br>
-        網路抄襲: {'是' if verdict.get('web_plagiarism') else '否'}
-        """
-
-        table_rows += f"""
-        <tr>
-            <td>{html.escape(display_text[:300])}...</td>
-            <td><a href="{source_url}" target="_blank">{html.escape(source_text[:200])}...</a></td>
-            <td>{similarity:.3f}</td>
-            <td>{judgement_html}</td>
-            <td>{html.escape(verdict.get('justification', 'N/A'))}</td>
-            <td>{verdict.get('confidence', 0.0):.2f}</td>
-        </tr>
-        """
-    
-    html_template = f"""
+_HTML_HEAD = """
     <html>
     <head>
         <title>抄襲與 AI 生成檢測報告: {doc_id}</title>
@@ -121,11 +45,13 @@ def _generate_html_report(original_text: str, analysis_results: List[Dict], doc_
         <p><strong>文件名稱:</strong> {doc_id}</p>
         
         <div class="summary">
-            <strong>報告總結:</strong> 本次分析針對指定章節，共發現 {len(analysis_results)} 個高風險段落。請檢視下方高亮原文與詳細分析表格。
+            <strong>報告總結:</strong> 本次分析針對指定章節，共發現 {count} 個高風險段落。請檢視下方高亮原文與詳細分析表格。{degraded_note}
         </div>
 
         <h2>高亮原文 (僅顯示被分析之章節)</h2>
-        <div class="content">{highlighted_text}</div>
+        <div class="content">"""
+
+_HTML_MIDDLE = """</div>
         
         <h2>詳細分析表格</h2>
         <table>
@@ -137,49 +63,204 @@ def _generate_html_report(original_text: str, analysis_results: List[Dict], doc_
                 <th>判斷理由</th>
                 <th>信賴度</th>
             </tr>
-            {table_rows}
+            """
+
+_HTML_TAIL = """
         </table>
     </body>
     </html>
     """
-    
-    report_path = os.path.join(config.REPORT_OUTPUT_DIR, f"{doc_id}_report.html")
-    with open(report_path, 'w', encoding='utf-8') as f:
-        f.write(html_template)
-    
-    return report_path
-
-
-def _generate_json_report(analysis_results: List[Dict], doc_id: str) -> str:
-    """產生一份機器可讀的 JSON 格式報告。"""
-    plagiarism_count = sum(1 for res in analysis_results if res.get('llm_verdict', {}).get('web_plagiarism'))
-    ai_count = sum(1 for res in analysis_results if res.get('llm_verdict', {}).get('ai_generated'))
-
-    output = {
-        "doc_id": doc_id,
-        "summary": {
-            "total_suspicious_chunks": len(analysis_results),
-            "plagiarism_chunks_count": plagiarism_count,
-            "ai_chunks_count": ai_count
-        },
-        "details": []
-    }
-
-    for res in analysis_results:
-        source_hit = res.get('source_hit') or {}
-        output['details'].append({
-            "original_chunk_metadata": res.get('original_chunk', {}).get('metadata'),
-            "original_chunk_text": res.get('original_chunk', {}).get('text'),
-            "llm_verdict": res.get('llm_verdict'),
+
+
+class StreamingReportWriter:
+    """
+    逐筆寫入的報告產生器。
+    每收到一個結果就把高亮原文、表格列與 JSON 明細寫進暫存檔，
+    close() 時再依序串接成最終的 HTML / JSON 報告，因此記憶體中不需保留全部結果。
+    結果必須依 start_char 由小到大送入（管線本來就是依序處理區塊）。
+    """
+
+    def __init__(self, original_text: str, doc_id: str):
+        os.makedirs(config.REPORT_OUTPUT_DIR, exist_ok=True)
+        self.original_text = original_text
+        self.doc_id = doc_id
+
+        self._content_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self._rows_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self._details_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self._written_pos = 0
+
+        self.total_count = 0
+        self.plagiarism_count = 0
+        self.ai_count = 0
+        # 因配額或遠端服務無法使用而未完整檢測的區塊 (只保留位置與略過的步驟)
+        self.degraded_chunks: List[Dict] = []
+
+    @property
+    def degraded_count(self) -> int:
+        return len(self.degraded_chunks)
+
+    def add_result(self, result: Dict):
+        if result.get('degraded'):
+            chunk_meta = result['original_chunk']['metadata']
+            self.degraded_chunks.append({
+                "chunk_id": chunk_meta.get('chunk_id'),
+                "start_char": chunk_meta['start_char'],
+                "end_char": chunk_meta['end_char'],
+                "skipped_steps": list(result['degraded']),
+            })
+        verdict = result.get('llm_verdict')
+        if not verdict:
+            # 沒有判定結果的區塊只列入「未完整檢測」，不寫入高亮與明細
+            return
+        source_hit = result.get('source_hit') or {}
+        chunk_meta = result['original_chunk']['metadata']
+        start = chunk_meta['start_char']
+        end = chunk_meta['end_char']
+
+        self.total_count += 1
+        if verdict.get('web_plagiarism'):
+            self.plagiarism_count += 1
+        if verdict.get('ai_generated'):
+            self.ai_count += 1
+
+        self._write_detail(result, verdict, source_hit)
+
+        if start < 0 or end > len(self.original_text):
+            print(f"偵測到無效的高亮位置 (start={start}, end={end})，已跳過此區塊。")
+            return
+
+        self._write_highlight(start, end, verdict)
+        self._write_row(start, end, verdict, source_hit)
+
+    def _write_highlight(self, start: int, end: int, verdict: Dict):
+        # 區塊之間有重疊 (CHUNK_OVERLAP)，已經寫出的部分不再重複高亮
+        start = max(start, self._written_pos)
+        if end <= start:
+            return
+
+        is_plagiarism = verdict.get('web_plagiarism', False)
+        is_ai = verdict.get('ai_generated', False)
+        
+        color = "rgba(255, 255, 0, 0.4)"
+        if is_plagiarism and is_ai:
+             color = "rgba(255, 0, 255, 0.5)"
+        elif is_plagiarism:
+            color = "rgba(255, 77, 77, 0.5)"
+        elif is_ai:
+            color = "rgba(255, 165, 0, 0.5)"
+
+        tooltip_text = f"判斷理由: {html.escape(verdict.get('justification', 'N/A'))}\n"
+        tooltip_text += f"信賴度: {verdict.get('confidence', 0.0):.2f}"
+
+        self._content_file.write(html.escape(self.original_text[self._written_pos:start]))
+        original_segment = self.original_text[start:end]
+        self._content_file.write(
+            f'<span class="highlight" style="background-color:{color};" title="{tooltip_text}">{html.escape(original_segment)}</span>'
+        )
+        self._written_pos = end
+
+    def _write_row(self, start: int, end: int, verdict: Dict, source_hit: Dict):
+        display_text = self.original_text[start:end]
+
+        source_text = source_hit.get('matched_span', 'N/A (無網路來源)')
+        source_url = source_hit.get('url', '#')
+        similarity = source_hit.get('similarity', 0.0)
+        
+        judgement_html = f"""
+        AI 生成: {'是' if verdict.get('ai_generated') else '否'}<br>
+        網路抄襲: {'是' if verdict.get('web_plagiarism') else '否'}
+        """
+
+        self._rows_file.write(f"""
+        <tr>
+            <td>{html.escape(display_text[:300])}...</td>
+            <td><a href="{html.escape(source_url)}" target="_blank">{html.escape(source_text[:200])}...</a></td>
+            <td>{similarity:.3f}</td>
+            <td>{judgement_html}</td>
+            <td>{html.escape(verdict.get('justification', 'N/A'))}</td>
+            <td>{verdict.get('confidence', 0.0):.2f}</td>
+        </tr>
+        """)
+
+    def _write_detail(self, result: Dict, verdict: Dict, source_hit: Dict):
+        matched_span = source_hit.get('matched_span')
+        detail = {
+            "original_chunk_metadata": result.get('original_chunk', {}).get('metadata'),
+            "original_chunk_text": result.get('original_chunk', {}).get('text'),
+            "llm_verdict": verdict,
+            "skipped_steps": result.get('degraded') or [],
             "source_details": {
                 "url": source_hit.get('url'),
                 "similarity_score": source_hit.get('similarity'),
-                "source_text_preview": source_hit.get('text', '')[:200] + '...' if source_hit.get('text') else None
+                "span_start": source_hit.get('span_start'),
+                "span_end": source_hit.get('span_end'),
+                "source_text_preview": matched_span[:200] + '...' if matched_span else None
             }
-        })
+        }
+        # 每筆明細獨立一行，close() 時再組成 JSON 陣列
+        self._details_file.write(json.dumps(detail, ensure_ascii=False, default=float) + "\n")
+
+    def close(self) -> Optional[Tuple[str, str]]:
+        """輸出最終報告並回傳 (html_path, json_path)；沒有可疑段落也沒有未完整檢測的區塊時不產生報告。"""
+        try:
+            if self.total_count == 0 and not self.degraded_chunks:
+                print("沒有發現可疑段落，不生成報告。")
+                return None
+
+            html_report_path = self._finish_html_report()
+            print(f"HTML 報告已生成: {html_report_path}")
+
+            json_report_path = self._finish_json_report()
+            print(f"JSON 總結已生成: {json_report_path}")
+            return html_report_path, json_report_path
+        finally:
+            self._content_file.close()
+            self._rows_file.close()
+            self._details_file.close()
+
+    def _finish_html_report(self) -> str:
+        self._content_file.write(html.escape(self.original_text[self._written_pos:]))
+        self._written_pos = len(self.original_text)
+
+        report_path = os.path.join(config.REPORT_OUTPUT_DIR, f"{self.doc_id}_report.html")
+        with open(report_path, 'w', encoding='utf-8') as f:
+            degraded_note = ""
+            if self.degraded_chunks:
+                degraded_note = (f"<br><strong>注意:</strong> 另有 {self.degraded_count} 個區塊因配額或遠端服務無法使用"
+                                 f"而未完整檢測，「未發現問題」不代表已確認沒有問題，明細見 JSON 總結。")
+            f.write(_HTML_HEAD.format(doc_id=html.escape(self.doc_id), count=self.total_count,
+                                      degraded_note=degraded_note))
+            self._content_file.seek(0)
+            shutil.copyfileobj(self._content_file, f, config.REPORT_COPY_BUFFER)
+            f.write(_HTML_MIDDLE)
+            self._rows_file.seek(0)
+            shutil.copyfileobj(self._rows_file, f, config.REPORT_COPY_BUFFER)
+            f.write(_HTML_TAIL)
+        
+        return report_path
+
+    def _finish_json_report(self) -> str:
+        """產生一份機器可讀的 JSON 格式報告。"""
+        summary = {
+            "total_suspicious_chunks": self.total_count,
+            "plagiarism_chunks_count": self.plagiarism_count,
+            "ai_chunks_count": self.ai_count,
+            "degraded_chunks_count": self.degraded_count,
+            "degraded_chunks": self.degraded_chunks
+        }
 
-    report_path = os.path.join(config.REPORT_OUTPUT_DIR, f"{doc_id}_summary.json")
-    with open(report_path, 'w', encoding='utf-8') as f:
-        json.dump(output, f, ensure_ascii=False, indent=4)
+        report_path = os.path.join(config.REPORT_OUTPUT_DIR, f"{self.doc_id}_summary.json")
+        with open(report_path, 'w', encoding='utf-8') as f:
+            f.write('{\n')
+            f.write(f'    "doc_id": {json.dumps(self.doc_id, ensure_ascii=False)},\n')
+            summary_json = json.dumps(summary, ensure_ascii=False, indent=4).replace('\n', '\n    ')
+            f.write(f'    "summary": {summary_json},\n')
+            f.write('    "details": [')
+            self._details_file.seek(0)
+            for i, line in enumerate(self._details_file):
+                f.write(',\n        ' if i else '\n        ')
+                f.write(line.rstrip('\n'))
+            f.write('\n    ]\n}')
         
-    return report_path
\ No newline at end of file
+        return report_path
@@ -0,0 +1,386 @@
+# resilience.py
+"""
+遠端呼叫 (Gemini、Custom Search、網頁下載) 共用的韌性層。
+
+每個 endpoint 的設定見 config.RESILIENCE_ENDPOINTS，提供：
+- 每次嘗試的逾時與整體 deadline
+- 指數退避加隨機抖動 (full jitter) 的重試
+- 選用的 hedged request：第一個請求超過 p95 延遲仍未回應時，再送出一個重複請求，取先成功者
+- 斷路器：連續失敗達門檻後直接快速失敗，冷卻後放行一個試探請求
+- 每個 endpoint 的統計 (get_stats())
+- 傳入 quota_tokens 時，每次嘗試前都先向 quota_scheduler 取得配額許可
+
+用法：
+    response = resilience.call("gemini.generate", model.generate_content, prompt,
+                               quota_tokens=quota_scheduler.estimate_tokens(prompt))
+"""
+import collections
+import concurrent.futures
+import contextvars
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import config
+import quota_scheduler
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟中，呼叫被直接拒絕。"""
+
+
+class DeadlineExceeded(Exception):
+    """單次嘗試逾時，或整體 deadline 已用完。"""
+
+
+class FetchError(Exception):
+    """下載的暫時性失敗：連線錯誤、逾時、429 或 5xx。失效連結 (其他 4xx) 不屬於此類，不應重試。"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class EndpointPolicy:
+    def __init__(self, name: str, **overrides):
+        settings = {**config.RESILIENCE_DEFAULTS, **overrides}
+        self.name = name
+        self.timeout = settings['timeout']
+        self.deadline = settings['deadline']
+        self.max_attempts = settings['max_attempts']
+        self.backoff_base = settings['backoff_base']
+        self.backoff_max = settings['backoff_max']
+        self.hedge = settings['hedge']
+        self.hedge_after = settings['hedge_after']
+        self.hedge_min_samples = settings['hedge_min_samples']
+        self.failure_threshold = settings['failure_threshold']
+        self.reset_timeout = settings['reset_timeout']
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # 冷卻結束，只放行一個試探請求
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def release_probe(self):
+        """試探請求沒有真正送出 (例如配額不足) 時歸還名額，讓下一個呼叫者可以再試探。"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"      - [斷路器] 連續失敗 {self.consecutive_failures} 次，暫停呼叫 {self.reset_timeout:g} 秒。")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class EndpointStats:
+    def __init__(self):
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.short_circuits = 0
+        self.quota_denied = 0
+        self.latencies = collections.deque(maxlen=config.RESILIENCE_LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def incr(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def add_latency(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def as_dict(self) -> Dict[str, Any]:
+        result = {
+            "calls": self.calls,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "short_circuits": self.short_circuits,
+            "quota_denied": self.quota_denied,
+        }
+        for p in (50, 95, 99):
+            latency = self.percentile(p)
+            result[f"p{p}_ms"] = round(latency * 1000, 1) if latency is not None else None
+        return result
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """只有暫時性錯誤 (逾時、連線錯誤、429、5xx) 才值得重試。"""
+    if isinstance(exc, (CircuitOpenError, quota_scheduler.QuotaError)):
+        return False
+    if isinstance(exc, (DeadlineExceeded, FetchError, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(exc, (ValueError, TypeError, KeyError)):
+        return False
+
+    # google.api_core 的例外帶有 .code；requests 的 HTTPError 帶有 .response.status_code
+    status = getattr(exc, 'code', None)
+    if not isinstance(status, int):
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    if isinstance(status, int):
+        return status in (408, 429) or status >= 500
+    return True
+
+
+class ResilientCaller:
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.RESILIENCE_MAX_THREADS, thread_name_prefix="resilience"
+        )
+        self._policies: Dict[str, EndpointPolicy] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._stats: Dict[str, EndpointStats] = {}
+        self._lock = threading.Lock()
+
+    def policy(self, endpoint: str) -> EndpointPolicy:
+        with self._lock:
+            policy = self._policies.get(endpoint)
+            if policy is None:
+                overrides = config.RESILIENCE_ENDPOINTS.get(endpoint, {})
+                policy = self._policies[endpoint] = EndpointPolicy(endpoint, **overrides)
+            return policy
+
+    def _breaker(self, key: str, policy: EndpointPolicy) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(policy.failure_threshold, policy.reset_timeout)
+            return breaker
+
+    def _endpoint_stats(self, endpoint: str) -> EndpointStats:
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats()
+            return stats
+
+    def call(self, endpoint: str, fn: Callable, *args, breaker_key: Optional[str] = None,
+             quota_tokens: Optional[int] = None, **kwargs) -> Any:
+        policy = self.policy(endpoint)
+        stats = self._endpoint_stats(endpoint)
+        breaker = self._breaker(breaker_key or endpoint, policy)
+        quota = (endpoint, quota_tokens) if quota_tokens is not None else None
+        deadline = None
+        stats.incr('calls')
+
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                stats.incr('short_circuits')
+                raise CircuitOpenError(f"{breaker_key or endpoint} 斷路器開啟中，暫停呼叫")
+
+            # 重試前先確認還有時間，避免為不會送出的嘗試扣配額
+            if deadline is not None and deadline - time.monotonic() <= 0:
+                breaker.release_probe()
+                stats.incr('failures')
+                raise DeadlineExceeded(f"{endpoint} 超過整體時限 {policy.deadline} 秒")
+
+            # 重試也會消耗配額，所以每次嘗試前都要重新取得許可
+            if quota:
+                try:
+                    quota_scheduler.acquire(*quota)
+                except quota_scheduler.QuotaError:
+                    # 請求沒有送出，不能讓斷路器卡在 half-open
+                    breaker.release_probe()
+                    stats.incr('quota_denied')
+                    raise
+            if deadline is None:
+                # 排隊等配額的時間不計入 deadline
+                deadline = time.monotonic() + policy.deadline
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # 排隊等配額期間 deadline 已過，這次嘗試不會送出，退還剛扣的配額
+                if quota:
+                    quota_scheduler.refund(*quota)
+                breaker.release_probe()
+                stats.incr('failures')
+                raise DeadlineExceeded(f"{endpoint} 超過整體時限 {policy.deadline} 秒")
+
+            try:
+                result = self._attempt(policy, stats, fn, args, kwargs, min(policy.timeout, remaining), quota)
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    # 對方有回應 (例如 400)，代表服務本身正常，不應讓斷路器開啟
+                    breaker.record_success()
+                attempt += 1
+                if not retryable or attempt >= policy.max_attempts:
+                    stats.incr('failures')
+                    raise
+                stats.incr('retries')
+                backoff = random.uniform(0, min(policy.backoff_max, policy.backoff_base * (2 ** (attempt - 1))))
+                time.sleep(max(0.0, min(backoff, deadline - time.monotonic())))
+                continue
+
+            breaker.record_success()
+            stats.incr('successes')
+            return result
+
+    def _submit(self, fn: Callable, args, kwargs) -> concurrent.futures.Future:
+        # 每個請求各自複製 context，讓 contextvars (例如目前處理的文件) 傳到執行緒中
+        ctx = contextvars.copy_context()
+        return self._executor.submit(ctx.run, fn, *args, **kwargs)
+
+    def _hedge_delay(self, policy: EndpointPolicy, stats: EndpointStats) -> Optional[float]:
+        if not policy.hedge:
+            return None
+        if policy.hedge_after is not None:
+            return policy.hedge_after
+        if len(stats.latencies) < policy.hedge_min_samples:
+            return None
+        return stats.percentile(95)
+
+    def _attempt(self, policy: EndpointPolicy, stats: EndpointStats, fn: Callable, args, kwargs, timeout: float,
+                 quota: Optional[tuple] = None) -> Any:
+        start = time.monotonic()
+        end = start + timeout
+        pending = {self._submit(fn, args, kwargs)}
+        hedged_future = None
+        first_error = None
+
+        hedge_delay = self._hedge_delay(policy, stats)
+        if hedge_delay is not None and hedge_delay < timeout:
+            done, pending = concurrent.futures.wait(pending, timeout=hedge_delay)
+            result = self._first_success(done, stats, start, hedged_future)
+            if result is not _NO_RESULT:
+                return result
+            first_error = self._first_error(done)
+            # hedge 是可有可無的請求，配額或預算不足時就不送
+            if pending and first_error is None and (quota is None or quota_scheduler.try_acquire(*quota)):
+                stats.incr('hedges')
+                hedged_future = self._submit(fn, args, kwargs)
+                pending.add(hedged_future)
+
+        while pending:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = concurrent.futures.wait(
+                pending, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            result = self._first_success(done, stats, start, hedged_future)
+            if result is not _NO_RESULT:
+                return result
+            first_error = first_error or self._first_error(done)
+
+        if first_error is not None and not pending:
+            raise first_error
+        # 逾時的請求無法中斷，只能放著讓它自行結束，結果會被丟棄
+        stats.incr('timeouts')
+        raise DeadlineExceeded(f"{policy.name} 單次呼叫超過 {timeout:.1f} 秒")
+
+    @staticmethod
+    def _first_success(done, stats: EndpointStats, start: float, hedged_future) -> Any:
+        for future in done:
+            if future.exception() is None:
+                stats.add_latency(time.monotonic() - start)
+                if future is hedged_future:
+                    stats.incr('hedge_wins')
+                return future.result()
+        return _NO_RESULT
+
+    @staticmethod
+    def _first_error(done) -> Optional[BaseException]:
+        for future in done:
+            if future.exception() is not None:
+                return future.exception()
+        return None
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            stats = dict(self._stats)
+            breakers = dict(self._breakers)
+        result = {endpoint: s.as_dict() for endpoint, s in stats.items()}
+        result["circuit_breakers"] = {
+            key: b.state for key, b in breakers.items() if b.state != CircuitBreaker.CLOSED
+        }
+        return result
+
+
+_NO_RESULT = object()
+_default_caller: Optional[ResilientCaller] = None
+_default_lock = threading.Lock()
+
+
+def get_caller() -> ResilientCaller:
+    """整個 process 共用一個 ResilientCaller，斷路器與統計才能跨服務累積。"""
+    global _default_caller
+    if _default_caller is None:
+        with _default_lock:
+            if _default_caller is None:
+                _default_caller = ResilientCaller()
+    return _default_caller
+
+
+def call(endpoint: str, fn: Callable, *args, breaker_key: Optional[str] = None,
+         quota_tokens: Optional[int] = None, **kwargs) -> Any:
+    return get_caller().call(endpoint, fn, *args, breaker_key=breaker_key, quota_tokens=quota_tokens, **kwargs)
+
+
+def endpoint_timeout(endpoint: str) -> float:
+    """單次嘗試的逾時秒數，可直接傳給底層 client（例如 requests 的 timeout）。"""
+    return get_caller().policy(endpoint).timeout
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    return get_caller().get_stats()
+
+
+def print_stats():
+    for endpoint, s in get_stats().items():
+        if endpoint == "circuit_breakers":
+            if s:
+                print(f"  - 斷路器未關閉: {s}")
+            continue
+        print(f"  - {endpoint}: 呼叫 {s['calls']} 次, 失敗 {s['failures']}, 重試 {s['retries']}, "
+              f"逾時 {s['timeouts']}, hedge {s['hedges']} (勝 {s['hedge_wins']}), "
+              f"斷路 {s['short_circuits']}, 配額拒絕 {s['quota_denied']}, p50/p95/p99 = {s['p50_ms']}/{s['p95_ms']}/{s['p99_ms']} ms")
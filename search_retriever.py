@@ -1,21 +1,41 @@
 # search_retriever.py
-import requests
-from typing import List, Dict, Optional
-from trafilatura import fetch_url, extract
+from typing import List, Dict, Optional, Iterator, Tuple
+from urllib.parse import urlparse
 import config
+import quota_scheduler
+import resilience
 from cache_manager import CacheManager
-import time
+
+
+class RetrievalError(Exception):
+    """搜尋或下載因遠端服務無法使用而失敗（重試用完、逾時或斷路器開啟），與「沒有結果」不同。"""
+
+
+def _mark_degraded(degraded: Optional[List[str]], step: str):
+    if degraded is not None and step not in degraded:
+        degraded.append(step)
+
 
 class SearchRetriever:
     def __init__(self, cache_manager: CacheManager):
         self.cache = cache_manager
 
     def search_google(self, query: str) -> List[Dict]:
-        """使用 Google Programmable Search API 進行網頁搜尋。"""
-        cached = self.cache.get_query_cache(f"google:{query}")
+        """使用 Google Programmable Search API 進行網頁搜尋。API 無法使用時拋出 RetrievalError。"""
+        cache_key = f"google:{query}"
+        cached = self.cache.get_query_cache(cache_key)
         if cached:
             return cached
 
+        # 多個 worker 同時搜尋同一個查詢時，只有一個會真正呼叫 API，其餘等待後讀快取
+        with self.cache.single_flight(cache_key):
+            cached = self.cache.get_query_cache(cache_key)
+            if cached:
+                return cached
+            return self._search_google_uncached(query, cache_key)
+
+    def _search_google_uncached(self, query: str, cache_key: str) -> List[Dict]:
+        import requests  # 延遲載入，完全命中快取時不需要
         url = "https://www.googleapis.com/customsearch/v1"
         params = {
             'key': config.GOOGLE_API_KEY_SEARCH,
@@ -23,53 +43,120 @@ class SearchRetriever:
             'q': query,
             'num': config.SEARCH_RESULTS_PER_QUERY
         }
-        try:
-            response = requests.get(url, params=params)
+        def _request():
+            response = requests.get(url, params=params, timeout=resilience.endpoint_timeout("search.google"))
             response.raise_for_status()
+            return response
+
+        try:
+            response = resilience.call("search.google", _request, quota_tokens=0)
             results = response.json().get('items', [])
             if not results:
                  return []
             extracted = [{"title": r.get('title', ''), "link": r.get('link', '')} for r in results]
-            self.cache.set_query_cache(f"google:{query}", extracted)
+            self.cache.set_query_cache(cache_key, extracted)
             return extracted
         except requests.exceptions.RequestException as e:
             if '429' in str(e):
                 print(f"    - [警告] Google Search API 速率過快 (429)，該次搜尋失敗。")
             else:
                 print(f"    - [錯誤] Google Search API 發生錯誤: {e}")
-            return []
+            raise RetrievalError(str(e)) from e
+        except (resilience.CircuitOpenError, resilience.DeadlineExceeded) as e:
+            print(f"    - [錯誤] Google Search API 無法使用: {e}")
+            raise RetrievalError(str(e)) from e
 
-    def run_searches(self, queries: List[str]) -> Dict[str, str]:
-        """對一組查詢執行所有搜尋，並回傳去重的 URL 字典。"""
+    def run_searches(self, queries: List[str], degraded: Optional[List[str]] = None) -> Dict[str, str]:
+        """
+        對一組查詢執行所有搜尋，並回傳去重的 URL 字典。
+        有查詢因 API 無法使用而失敗時，在 degraded 中記錄 "web_search"，表示比對結果不完整。
+        """
         all_urls = {}
         for q in queries:
-            # =================================================================
-            # 【修改處】將延遲增加到 2 秒，以確保穩定性
-            time.sleep(2)
-            # =================================================================
-            
+            # 【修改處】原本固定延遲 2 秒；速率限制現在由 quota_scheduler 依 config.QUOTA_LIMITS 控制，
+            # 命中快取的查詢不必再等待
             print(f"    - 正在搜尋關鍵字: \"{q[:50]}...\"")
-            google_results = self.search_google(q)
+            try:
+                google_results = self.search_google(q)
+            except quota_scheduler.QuotaError as e:
+                # 預算用完時保留已經找到的來源，不再送出新的查詢
+                print(f"    - [降級] 停止後續搜尋: {e}")
+                _mark_degraded(degraded, "web_search")
+                break
+            except RetrievalError:
+                _mark_degraded(degraded, "web_search")
+                continue
             for res in google_results:
                 if res.get('link'): # 確保連結存在
                     all_urls[res['link']] = res.get('title', '無標題')
         return all_urls
 
     def download_and_clean(self, url: str) -> Optional[str]:
-        """下載網頁內容並使用 trafilatura 清理，支援快取。"""
+        """
+        下載網頁內容並使用 trafilatura 清理，支援快取。
+        失效連結 (4xx)、或網頁沒有可擷取的內文時回傳 None；
+        連線錯誤、逾時或 5xx 在重試用完 (或斷路器開啟) 後拋出 RetrievalError。
+        """
         cached_content = self.cache.get_content_cache(url)
         if cached_content and 'cleaned_text' in cached_content:
             return cached_content['cleaned_text']
 
+        with self.cache.single_flight(f"fetch:{url}"):
+            cached_content = self.cache.get_content_cache(url)
+            if cached_content and 'cleaned_text' in cached_content:
+                return cached_content['cleaned_text']
+            return self._download_and_clean_uncached(url)
+
+    def _download_and_clean_uncached(self, url: str) -> Optional[str]:
+        # 延遲載入，完全命中快取時不需要
+        from trafilatura import extract
+        from trafilatura.downloads import fetch_response
+
+        def _fetch() -> Optional[str]:
+            # fetch_url 對任何失敗都只回傳 None；改用 fetch_response 取得狀態碼，才能區分暫時性錯誤與失效連結
+            response = fetch_response(url, decode=True)
+            if response is None:
+                raise resilience.FetchError(f"連線失敗或逾時: {url}")
+            if response.status == 429 or response.status >= 500:
+                raise resilience.FetchError(f"HTTP {response.status}: {url}", status=response.status)
+            if response.status != 200 or not response.html:
+                # 404、403 等失效連結或空白內容：不重試、不計入斷路器，也不算降級
+                print(f"      - [略過] 來源無法使用 (HTTP {response.status}): {url}")
+                return None
+            return response.html
+
+        try:
+            # 逾時、重試與 hedge 由韌性層處理；斷路器以網站為單位，某個網站掛掉時不會拖慢其他來源
+            downloaded = resilience.call("fetch", _fetch, breaker_key=f"fetch:{urlparse(url).netloc}")
+        except Exception as e:
+            print(f"      - [錯誤] 下載失敗: {url}, 原因: {e}")
+            raise RetrievalError(str(e)) from e
+        if downloaded is None:
+            return None
+
         try:
-            downloaded = fetch_url(url, timeout=15) # 增加超時設定
-            if downloaded:
-                cleaned_text = extract(downloaded, include_comments=False, include_tables=False)
-                if cleaned_text:
-                    self.cache.set_content_cache(url, {'cleaned_text': cleaned_text})
-                    return cleaned_text
+            cleaned_text = extract(downloaded, include_comments=False, include_tables=False)
         except Exception as e:
-            print(f"      - [錯誤] 下載或清理失敗: {url}, 原因: {e}")
+            print(f"      - [錯誤] 清理失敗: {url}, 原因: {e}")
             return None
-            
-        return None
\ No newline at end of file
+        if cleaned_text:
+            self.cache.update_content_cache(url, {'cleaned_text': cleaned_text})
+            return cleaned_text
+        return None
+
+    def iter_candidate_pages(self, urls_titles: Dict[str, str], limit: int = 5,
+                             degraded: Optional[List[str]] = None) -> Iterator[Tuple[str, str]]:
+        """
+        逐一下載候選來源並產生 (url, cleaned_text)。
+        呼叫端比對完一頁即可釋放，不需同時把所有來源全文放在記憶體中。
+        有來源下載失敗時略過該來源，並在 degraded 中記錄 "source_fetch"。
+        """
+        for url, title in list(urls_titles.items())[:limit]:
+            print(f"    - 下載與清理來源: {title} ({url})")
+            try:
+                content = self.download_and_clean(url)
+            except RetrievalError:
+                _mark_degraded(degraded, "source_fetch")
+                continue
+            if content:
+                yield url, content
\ No newline at end of file
@@ -1,67 +1,124 @@
 # similarity_service.py
-import google.generativeai as genai # 替換 import
-from typing import List, Dict, Tuple
-from numpy import dot
-from numpy.linalg import norm
-import numpy as np
+from typing import List, Dict, Tuple, Iterable, Optional, Union
 
 import config
+import embedding_store
+import quota_scheduler
+import resilience
 from cache_manager import CacheManager
+from embedding_store import StoredEmbedding
+from genai_client import get_genai
+
+def _mark_degraded(degraded: Optional[List[str]], step: str):
+    if degraded is not None and step not in degraded:
+        degraded.append(step)
+
 
 class SimilarityService:
     def __init__(self, cache_manager: CacheManager):
         self.cache = cache_manager
 
-    def _cosine_similarity(self, a, b):
-        return dot(a, b) / (norm(a) * norm(b))
-    
-    def get_embedding(self, text: str, url: str = "local") -> List[float]:
-        """獲取文字的 embedding，優先從快取讀取。"""
-        if url != "local":
+    def get_embedding(self, text: str, url: str = "local") -> StoredEmbedding:
+        """
+        獲取文字的 embedding，優先從快取讀取。
+        回傳快取中的儲存格式 (float list 或量化後的 dict，見 embedding_store)，交給 embedding_store 解讀。
+        """
+        if url == "local":
+            return self._embed(text)
+
+        cached_data = self.cache.get_content_cache(url)
+        if cached_data and 'embedding' in cached_data:
+            return cached_data['embedding']
+
+        # 同一個來源只讓一個 worker 計算 embedding
+        with self.cache.single_flight(f"embed:{url}"):
             cached_data = self.cache.get_content_cache(url)
             if cached_data and 'embedding' in cached_data:
                 return cached_data['embedding']
 
+            embedding = embedding_store.encode_embedding(self._embed(text))
+            # 在鎖內合併寫回，確保不會覆寫掉 text
+            self.cache.update_content_cache(url, {'embedding': embedding})
+            return embedding
+
+    def _embed(self, text: str) -> List[float]:
         # 注意：genai 的 embedding 介面與 openai 不同
-        response = genai.embed_content(
+        response = resilience.call(
+            "gemini.embed",
+            get_genai().embed_content,
             model=config.EMBEDDING_MODEL,
             content=text,
-            task_type="RETRIEVAL_DOCUMENT" 
+            task_type="RETRIEVAL_DOCUMENT",
+            quota_tokens=quota_scheduler.estimate_tokens(text)
         )
-        embedding = response['embedding']
+        return response['embedding']
 
-        # 更新快取
-        if url != "local":
-            # 確保不會覆寫掉 text
-            updated_data = self.cache.get_content_cache(url) or {}
-            updated_data['embedding'] = embedding
-            self.cache.set_content_cache(url, updated_data)
-        
-        return embedding
+    def _best_matching_span(self, target_chunk: str, content: str, span_chars: int) -> Tuple[int, int]:
+        """
+        以字元雙字組 (bigram) 重疊度，在來源全文中找出與目標區塊最相近的片段。
+        回傳 (start, end)，只保留這段即可，不必留存整篇來源。
+        """
+        if len(content) <= span_chars:
+            return 0, len(content)
 
-    def find_top_hits(self, target_chunk: str, candidate_pages: Dict[str, str]) -> List[Dict]:
+        target_bigrams = {target_chunk[i:i + 2] for i in range(len(target_chunk) - 1)}
+        best_start, best_score = 0, -1
+        step = max(1, span_chars // 2)
+        for start in range(0, len(content) - span_chars + step, step):
+            window = content[start:start + span_chars].lower()
+            score = sum(1 for i in range(len(window) - 1) if window[i:i + 2] in target_bigrams)
+            if score > best_score:
+                best_start, best_score = start, score
+        return best_start, min(best_start + span_chars, len(content))
+
+    def find_top_hits(self, target_chunk: str,
+                      candidate_pages: Union[Dict[str, str], Iterable[Tuple[str, str]]],
+                      degraded: Optional[List[str]] = None) -> List[Dict]:
         """
         在記憶體中進行語意比對，找出最相似的段落。
-        candidate_pages: {url: cleaned_text}
+        candidate_pages: {url: cleaned_text}，或逐一產生 (url, cleaned_text) 的 iterator。
+        命中結果只保留來源參照與比對到的片段 (matched_span)，不保留來源全文。
+        embedding 呼叫失敗 (重試用完、逾時或斷路器開啟) 時略過該來源，並在 degraded 中記錄 "similarity"；
+        配額錯誤 (QuotaError) 則照常拋出，交給管線降級。
         """
-        if not candidate_pages:
-            return []
+        pages = candidate_pages.items() if isinstance(candidate_pages, dict) else candidate_pages
 
-        target_vec = self.get_embedding(target_chunk)
-        
+        target_vec = None
         top_hits = []
-        for url, content in candidate_pages.items():
+        for url, content in pages:
             if not content: continue
-            
+
+            # 第一個候選來源出現時才計算目標向量，沒有候選來源就不呼叫 API
+            if target_vec is None:
+                try:
+                    target_vec = embedding_store.decode_embedding(self.get_embedding(target_chunk))
+                except quota_scheduler.QuotaError:
+                    raise
+                except Exception as e:
+                    # 沒有目標向量就無法比對任何來源
+                    print(f"    - [錯誤] 目標區塊的 embedding 失敗，略過來源比對: {e}")
+                    _mark_degraded(degraded, "similarity")
+                    break
+
             # 直接比對整篇文章
-            candidate_vec = self.get_embedding(content, url)
+            try:
+                candidate_vec = self.get_embedding(content, url)
+            except quota_scheduler.QuotaError:
+                raise
+            except Exception as e:
+                print(f"    - [錯誤] 來源的 embedding 失敗，略過: {url}, 原因: {e}")
+                _mark_degraded(degraded, "similarity")
+                continue
             
-            score = self._cosine_similarity(target_vec, candidate_vec)
+            score = embedding_store.score(candidate_vec, target_vec)
             
             if score >= config.SIMILARITY_THRESHOLD:
+                span_start, span_end = self._best_matching_span(target_chunk, content, config.HIT_SPAN_CHARS)
                 top_hits.append({
                     "url": url,
-                    "text": content,
+                    "matched_span": content[span_start:span_end],
+                    "span_start": span_start,
+                    "span_end": span_end,
                     "similarity": score
                 })
         
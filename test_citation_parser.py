@@ -0,0 +1,79 @@
+# test_citation_parser.py
+"""citation_parser.py 的正反例：這些規則決定哪些區塊只比對引用文獻。python -m pytest test_citation_parser.py"""
+import pytest
+
+from citation_parser import CITED, UNCITED, CitationIndex, extract_citations, parse_author_year_references
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("(Smith, 2020)", [("Smith", "2020")]),
+    ("(Smith & Lee, 2020; Wang et al., 2019, p. 5)", [("Smith & Lee", "2020"), ("Wang et al.", "2019")]),
+    ("Smith (2020) found", [("Smith", "2020")]),
+    ("Smith and Lee (2020, p. 12) argue", [("Smith and Lee", "2020")]),
+    ("（王小明，2020）", [("王小明", "2020")]),
+    ("文獻指出（王小明、李大華，2019；陳等人，2021，頁5）", [("王小明、李大華", "2019"), ("陳等人", "2021")]),
+    ("王小明（2020）指出", [("王小明", "2020")]),
+    ("研究者林美玲（2018）發現", [("林美玲", "2018")]),
+    ("根據王小明與李大華（2019）", [("王小明與李大華", "2019")]),
+    ("（見王小明，2020）", [("王小明", "2020")]),
+])
+def test_author_year_citations(text, expected):
+    assert [(c.authors, c.year) for c in extract_citations(text)] == expected
+
+
+def test_numbered_citations():
+    assert [c.number for c in extract_citations("as shown [1, 3-5]")] == [1, 3, 4, 5]
+
+
+@pytest.mark.parametrize("text", [
+    "In March (2020) the survey began.",
+    "The United States (2020) reported growth.",
+    "(March 2020)",
+    "（調查期間為2020年3月）",
+    "學生(2020)表示滿意",
+    "本研究(2021)發現",
+    "研究者(2019)認為",
+    "我們（2020）觀察到",
+])
+def test_not_citations(text):
+    assert extract_citations(text) == []
+
+
+REFERENCES = """
+Smith, J., & Lee, K. (2020). Learning from citations. Journal of Examples, 12(3), 45-67.
+Wang, L., Chen, M., Zhang, Y., & Liu, Q.
+    (2019). A long author list that wraps. Proceedings of Something.
+王小明、李大華（2019）。引用分析的方法。教育研究，5，1-20。
+陳大明（2021）。另一篇研究。
+"""
+
+
+def test_author_year_references():
+    assert parse_author_year_references(REFERENCES) == {
+        ("smith", "2020"), ("wang", "2019"), ("王小明", "2019"), ("陳大明", "2021")
+    }
+
+
+@pytest.mark.parametrize("paragraph, tier", [
+    ("Citations help readers trace ideas (Smith & Lee, 2020).", CITED),
+    ("Wang et al. (2019) extended this line of work.", CITED),
+    ("引用分析已有許多方法（王小明，2019）。", CITED),
+    ("陳等人（2021）也提出類似看法。", CITED),
+    # 參考文獻中沒有的引用不算，區塊仍需一般檢測
+    ("This sentence cites a work that is not listed (Brown, 2018).", UNCITED),
+    ("這段引用了清單中沒有的文獻（林美玲，2018）。", UNCITED),
+    ("Year mismatch is not enough (Smith, 2021).", UNCITED),
+])
+def test_tier_requires_reference_entry(paragraph, tier):
+    index = CitationIndex(paragraph)
+    index.load_references(REFERENCES)
+    assert index.tier(0, len(paragraph)) == tier
+
+
+def test_numbered_citations_resolve_through_bibliography():
+    text = "Transformers changed NLP [1]. Unlisted claim [7]."
+    index = CitationIndex(text)
+    index.load_references("[1] Vaswani, A. Attention is all you need. 2017.\n")
+    assert index.is_resolved(extract_citations(text)[0])
+    assert not index.is_resolved(extract_citations(text)[1])
+    assert index.citation_queries(0, len(text)) == ["Vaswani, A. Attention is all you need. 2017."]
@@ -0,0 +1,50 @@
+# test_resilience.py
+"""resilience.py 的回歸測試：python -m pytest test_resilience.py"""
+import time
+
+import pytest
+
+import quota_scheduler
+import resilience
+
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+    # 不要動到 cache/ 底下真正的配額資料庫
+    monkeypatch.setattr(quota_scheduler, "_scheduler", quota_scheduler.QuotaScheduler(str(tmp_path / "quota.sqlite")))
+
+
+def test_quota_error_during_probe_does_not_leave_breaker_half_open(scheduler):
+    caller = resilience.ResilientCaller()
+    breaker = caller._breaker("test.endpoint", caller.policy("test.endpoint"))
+    breaker.state = resilience.CircuitBreaker.OPEN
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout - 1
+
+    # 試探請求所屬文件的預算已用完：請求沒有送出
+    with quota_scheduler.document("doc-a", limits={"test.endpoint": 0}):
+        with pytest.raises(quota_scheduler.BudgetExceeded):
+            caller.call("test.endpoint", lambda: "ok", quota_tokens=1)
+    assert breaker.state != resilience.CircuitBreaker.HALF_OPEN
+
+    # 其他文件仍然可以送出試探請求，成功後斷路器關閉
+    with quota_scheduler.document("doc-b"):
+        assert caller.call("test.endpoint", lambda: "ok", quota_tokens=1) == "ok"
+    assert breaker.state == resilience.CircuitBreaker.CLOSED
+
+
+def test_retry_past_deadline_is_not_charged(scheduler):
+    caller = resilience.ResilientCaller()
+    caller._policies["test.deadline"] = resilience.EndpointPolicy(
+        "test.deadline", deadline=0.3, timeout=1, max_attempts=5
+    )
+    attempts = []
+
+    def slow():
+        attempts.append(1)
+        time.sleep(0.5)
+
+    # 第一次嘗試就用完整體時限，之後不應再為不會送出的重試扣預算
+    with quota_scheduler.document("doc-c") as budget:
+        with pytest.raises(resilience.DeadlineExceeded):
+            caller.call("test.deadline", slow, quota_tokens=1)
+    assert budget.used["test.deadline"] == len(attempts) == 1